@@ -0,0 +1,202 @@
+import os
+import gc
+import sys
+import json
+import time
+import glob
+import socket
+import argparse
+import platform
+import numpy as np
+from synthetic import ROOT, load_script, write_workspace
+
+
+# Benchmarks, in the order of the pipeline: ingestion, windowing, data preparation, dashboard
+BENCHMARKS = ['file_to_df', 'past_future_windows', 'pipeline', 'read_data_from_pickles', 'read_data_from_pickles_warm',
+              'read_store', 'prepare_data_for_map2', 'make_map1']
+
+# Parameters of the windows and of the pipeline (same as DEFAULT_CONFIG in 2.predictions.py)
+N_PAST = 120
+N_FUTURE = 24
+COLUMN_INDEX = 4
+
+# Timings shorter than this are too noisy to flag as regressions, in seconds
+NOISE_FLOOR = 0.005
+
+
+def measure(run, setup=None, repeats=3):
+    '''Time "run" (a function without arguments) "repeats" times, calling "setup" before each repeat (untimed).
+       Returns the output of the last call and the timings in seconds (min, median, max).
+    '''
+
+    timings = []
+
+    for i in range(0, repeats):
+        if setup is not None:
+            setup()
+        gc.collect()
+
+        start = time.perf_counter()
+        output = run()
+        timings.append(time.perf_counter() - start)
+
+    return output, {'min': min(timings), 'median': float(np.median(timings)), 'max': max(timings), 'repeats': repeats}
+
+
+def environment():
+    '''Machine and package versions the timings were measured with.'''
+
+    versions = {}
+    for module in ['numpy', 'pandas', 'sklearn', 'tensorflow', 'altair', 'folium']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+
+    return {'host': socket.gethostname(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'packages': versions}
+
+
+def benchmark_scale(folder, locations, benchmarks, repeats):
+    '''Run the benchmarks on the synthetic workspace in "folder" (see "write_workspace").
+       The dashboard reads its files relative to the working directory, so the benchmarks run from "folder".
+       Returns the timings (and sizes) of each benchmark.
+    '''
+
+    cleansing = load_script('0.data_cleansing.py', 'data_cleansing')
+    predictions = load_script('2.predictions.py', 'predictions')
+
+    if ROOT not in sys.path:
+        sys.path.append(ROOT)
+    from utils_class import Utils
+    import dashboard
+
+    raw_files = sorted(glob.glob(folder + '/data/raw/*.txt'))
+    clean_files = [folder + '/data/clean/' + location + '.csv' for location in locations]
+    results = {}
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+
+    try:
+        if 'file_to_df' in benchmarks:
+            _, results['file_to_df'] = measure(lambda: [cleansing.file_to_df(filepath) for filepath in raw_files], repeats=repeats)
+
+        if 'past_future_windows' in benchmarks:
+            scaled = [predictions.scale_data(predictions.read_data(filepath)[['rain_mm']].values)[0] for filepath in clean_files]
+            _, results['past_future_windows'] = measure(lambda: [predictions.past_future_windows(series, N_PAST, N_FUTURE) for series in scaled],
+                                                        repeats=repeats)
+
+        if 'pipeline' in benchmarks:
+            cutoff1 = predictions.read_data(clean_files[0])['timestamp'].iloc[0]
+            _, results['pipeline'] = measure(lambda: [predictions.pipeline(filepath, cutoff1, COLUMN_INDEX, N_PAST, N_FUTURE) for filepath in clean_files],
+                                             repeats=repeats)
+
+        # Cold: eval.pkl is loaded and the dfs are built again. Warm: a rerun of the dashboard, served from the shared cache
+        if 'read_data_from_pickles' in benchmarks:
+            _, results['read_data_from_pickles'] = measure(lambda: Utils.read_data_from_pickles(locations), setup=Utils.clear_caches, repeats=repeats)
+
+        if 'read_data_from_pickles_warm' in benchmarks:
+            Utils.read_data_from_pickles(locations)
+            _, results['read_data_from_pickles_warm'] = measure(lambda: Utils.read_data_from_pickles(locations), repeats=repeats)
+
+        if 'read_store' in benchmarks:
+            _, results['read_store'] = measure(lambda: Utils.read_store(locations), setup=Utils.clear_caches, repeats=repeats)
+
+        store = Utils.read_store(locations)
+
+        if 'prepare_data_for_map2' in benchmarks:
+            prepared, results['prepare_data_for_map2'] = measure(lambda: dashboard.prepare_data_for_map2(store), repeats=repeats)
+            results['prepare_data_for_map2']['rows'] = len(prepared)
+
+        # Cold: popup charts and the map are built again (as after a new version of the results)
+        if 'make_map1' in benchmarks:
+            html, results['make_map1'] = measure(lambda: dashboard.map1_html(store), setup=Utils.clear_caches, repeats=repeats)
+            results['make_map1']['html_bytes'] = len(html.encode('utf-8'))
+
+    finally:
+        os.chdir(cwd)
+        Utils.clear_caches()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Print the ratio of each timing (median) and size to the baseline, and return the regressions:
+       benchmarks more than "tolerance" (eg, 0.2 for 20%) slower or larger than the baseline.
+    '''
+
+    regressions = []
+
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            previous = baseline['results'].get(scale, {}).get(name)
+            if previous is None:
+                continue
+
+            ratio = result['median'] / previous['median']
+            line = '{:>5} stations  {:<28} {:>9.4f} s  x{:.2f}'.format(scale, name, result['median'], ratio)
+
+            if ratio > 1 + tolerance and previous['median'] > NOISE_FLOOR:
+                regressions.append((scale, name, 'median'))
+                line += '  REGRESSION'
+
+            if 'html_bytes' in result and 'html_bytes' in previous:
+                size_ratio = result['html_bytes'] / previous['html_bytes']
+                line += '  html x{:.2f}'.format(size_ratio)
+
+                if size_ratio > 1 + tolerance:
+                    regressions.append((scale, name, 'html_bytes'))
+                    line += '  REGRESSION'
+
+            print(line)
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of ingestion, windowing, data preparation and rendering on synthetic stations.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[6, 100, 1000], help='numbers of stations')
+    parser.add_argument('--years', type=int, default=60, help='length of the records, in years')
+    parser.add_argument('--repeats', type=int, default=3, help='repeats of each benchmark (the median is compared)')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='benchmarks to run')
+    parser.add_argument('--workspace', default=ROOT + '/benchmarks/workspace', help='folder of the synthetic data (reused across runs)')
+    parser.add_argument('--output', default=None, help='JSON file to save the results to (default: benchmarks/baselines/<host>.json)')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run: exits with an error if a benchmark regressed')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown (or growth of the HTML) tolerated by --compare')
+    args = parser.parse_args()
+
+    output = args.output or ROOT + '/benchmarks/baselines/' + socket.gethostname() + '.json'
+
+    # Read the baseline first, as it may be overwritten by the output
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as handle:
+            baseline = json.load(handle)
+
+    results = {}
+
+    for n_stations in args.scales:
+        folder = args.workspace + '/' + str(n_stations)
+        print('Generating ' + str(n_stations) + ' stations (' + str(args.years) + ' years) in ' + folder)
+        locations = write_workspace(folder, n_stations, n_years=args.years)
+
+        results[str(n_stations)] = benchmark_scale(folder, locations, args.only, args.repeats)
+
+        for name, result in results[str(n_stations)].items():
+            print('{:>5} stations  {:<28} {:>9.4f} s (median of {})'.format(n_stations, name, result['median'], result['repeats']))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'environment': environment(),
+                   'config': {'years': args.years, 'repeats': args.repeats, 'n_past': N_PAST, 'n_future': N_FUTURE},
+                   'results': results}, handle, indent=2)
+    print('Saved: ' + output)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+
+        if len(regressions) > 0:
+            sys.exit('Regressions: ' + ', '.join(scale + ' stations ' + name + ' (' + metric + ')' for scale, name, metric in regressions))
@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import pickle
+import importlib.util
+import numpy as np
+import pandas as pd
+
+
+# Folders of the app and of the pipeline scripts
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SCRIPTS = ROOT + '/scripts'
+
+# Last month of the synthetic records (the real files end in September 2021)
+LAST_YEAR = 2021
+
+# Months flagged as provisional at the end of each record, as in the real files
+N_PROVISIONAL = 6
+
+
+def load_script(filename, name):
+    '''Import a pipeline script as a module (script names start with a digit, so they can't be imported directly).'''
+
+    if SCRIPTS not in sys.path:
+        sys.path.append(SCRIPTS)
+
+    spec = importlib.util.spec_from_file_location(name, SCRIPTS + '/' + filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def station_names(n_stations):
+    '''Names of the synthetic stations (capitalised, like the raw files).'''
+
+    return ['Station{:04d}'.format(i) for i in range(1, n_stations + 1)]
+
+
+def raw_station_text(rng, n_years):
+    '''Text of a synthetic station file in the MetOffice format (see data/raw/):
+       two header lines, then one line per month with yyyy | mm | tmax | tmin | af | rain | sun.
+       Values are random but the file has the features handled by the cleansing code: missing values ("---")
+       at the start of the record, estimated values ("*"), automatic values ("#") and provisional months at the end.
+    '''
+
+    n_months = n_years * 12
+    first_year = LAST_YEAR - n_years + 1
+
+    rain = np.round(rng.gamma(shape=2.0, scale=30.0, size=n_months), 1)
+    tmax = np.round(rng.normal(14.0, 5.0, size=n_months), 1)
+    tmin = np.round(tmax - rng.uniform(4.0, 10.0, size=n_months), 1)
+    af = rng.poisson(2, size=n_months)
+    sun = np.round(rng.uniform(30.0, 250.0, size=n_months), 1)
+
+    missing = np.arange(n_months) < rng.randint(0, 24)
+    estimated = rng.uniform(size=n_months) < 0.02
+
+    lines = ['   yyyy  mm   tmax    tmin      af    rain     sun',
+             '              degC    degC    days      mm   hours']
+
+    for i in range(0, n_months):
+        rain_str = '---' if missing[i] else '{:.1f}'.format(rain[i]) + ('*' if estimated[i] else '')
+        provisional = i >= n_months - N_PROVISIONAL
+        sun_str = '{:.1f}'.format(sun[i]) + ('#' if provisional else '')
+
+        lines.append('   {:4d}  {:2d}   {:5.1f}   {:5.1f}     {:3d}   {:>6}  {:>7}'.format(
+                     first_year + i // 12, i % 12 + 1, tmax[i], tmin[i], af[i], rain_str, sun_str)
+                     + ('   Provisional' if provisional else ''))
+
+    return '\n'.join(lines) + '\n'
+
+
+def evaluation_entry(clean, cutoff1, n_future, rng, predictions_module):
+    '''Entry of a synthetic eval.pkl for one location (see results/evaluation/README.md).
+       Predictions are the validation values plus noise: the structure matters, not the accuracy.
+    '''
+
+    train, validation_df = predictions_module.slice_data(clean, cutoff1=cutoff1, n_future=n_future)
+
+    validation = validation_df[['rain_mm']].values
+    predictions = np.maximum(validation + rng.normal(0.0, 10.0, size=validation.shape), 0.0)
+    difference = validation - predictions
+    rmse = round(float(np.sqrt(np.mean(difference**2))), 2)
+
+    return [predictions, validation, difference, rmse, train, validation_df]
+
+
+def write_workspace(folder, n_stations, n_years=60, n_future=24, seed=0):
+    '''Write a synthetic copy of the data and results read by the pipeline and the dashboard to "folder":
+       data/raw/ (MetOffice files), data/clean/ (parsed by "file_to_df"), data/LOCATIONS.csv,
+       results/evaluation/eval.pkl and results/columnar/ (same writer as 2.predictions.py).
+       Training data start at the beginning of the records, so the dashboard shows all "n_years" years.
+       The workspace is only written again when its parameters change (see synthetic.json in the folder).
+       Returns the names of the locations (clean csv names).
+    '''
+
+    params = {'n_stations': n_stations, 'n_years': n_years, 'n_future': n_future, 'seed': seed}
+    marker = folder + '/synthetic.json'
+    locations = [name.lower() for name in station_names(n_stations)]
+
+    if os.path.exists(marker):
+        with open(marker, 'r') as handle:
+            if json.load(handle) == params:
+                return locations
+
+    cleansing = load_script('0.data_cleansing.py', 'data_cleansing')
+    predictions_module = load_script('2.predictions.py', 'predictions')
+
+    for subfolder in ['/data/raw', '/data/clean', '/results/evaluation', '/results/columnar']:
+        os.makedirs(folder + subfolder, exist_ok=True)
+
+    rng = np.random.RandomState(seed)
+    cutoff1 = str(LAST_YEAR - n_years + 1) + '-01-15'
+    evaluation = {}
+
+    for name, location in zip(station_names(n_stations), locations):
+        raw_filepath = folder + '/data/raw/' + name + '.txt'
+        with open(raw_filepath, 'w') as handle:
+            handle.write(raw_station_text(rng, n_years))
+
+        clean_filepath = cleansing.ingest_file(raw_filepath, folder + '/data/clean')
+        clean = predictions_module.read_data(clean_filepath)
+
+        evaluation[location] = evaluation_entry(clean, cutoff1, n_future, rng, predictions_module)
+
+    # Stations scattered over the South of England, like the real ones
+    pd.DataFrame({'Station': station_names(n_stations),
+                  'Lat': np.round(rng.uniform(50.5, 52.8, size=n_stations), 3),
+                  'Lon': np.round(rng.uniform(-2.0, 1.8, size=n_stations), 3)}).to_csv(folder + '/data/LOCATIONS.csv', index=False)
+
+    with open(folder + '/results/evaluation/eval.pkl', 'wb') as handle:
+        pickle.dump(evaluation, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    if ROOT not in sys.path:
+        sys.path.append(ROOT)
+    import columnar
+
+    columnar.write_columnar(evaluation, folder)
+
+    with open(marker, 'w') as handle:
+        json.dump(params, handle, indent=2)
+
+    return locations
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+# Writer and readers of the columnar results (results/columnar/, see results/README.md)
+# Only NumPy is needed, so the pipeline scripts can publish results without importing the dashboard's dependencies
+
+
+def read_manifest(filepath):
+    '''Read JSON manifest.'''
+
+    with open(filepath, 'r') as f:
+        manifest = json.load(f)
+
+    return manifest
+
+
+def load_arrays(manifest, folder, location):
+    '''Memory-map the arrays of a single location listed in "manifest" (files are relative to "folder").
+       Only the files of the location requested are opened.
+    '''
+
+    arrays = {}
+
+    for name, entry in manifest['locations'][location]['arrays'].items():
+        arrays[name] = np.load(folder + '/' + entry['file'], mmap_mode='r', allow_pickle=False)
+
+    return arrays
+
+
+def write_columnar(evaluation, root, update=False):
+    '''Write the series needed by the dashboard as one .npy file per array and location, plus a JSON manifest.
+       "evaluation" has the same structure as eval.pkl (see results/evaluation/README.md).
+       With "update", only the locations in "evaluation" are written and the other locations of the manifest are kept.
+       Array files are named after their content hash and never overwritten: a new version is published atomically by
+       replacing the manifest, so readers see either the previous version or the new one, never a mix of both.
+       Files of the previous manifest are kept (readers may still be loading them), older ones are deleted.
+    '''
+
+    folder = root + '/results/columnar'
+    manifest = {'format': 1, 'locations': {}}
+    previous = {'locations': {}}
+
+    if os.path.exists(folder + '/manifest.json'):
+        previous = read_manifest(folder + '/manifest.json')
+        if update:
+            manifest = json.loads(json.dumps(previous))
+
+    for location in evaluation.keys():
+        os.makedirs(folder + '/' + location, exist_ok=True)
+
+        arrays = {'predictions': np.ravel(evaluation[location][0]),
+                  'training_data': evaluation[location][4]['rain_mm'].values,
+                  'training_timeline': evaluation[location][4]['timestamp'].values.astype('datetime64[ns]'),
+                  'prediction_timeline': evaluation[location][5]['timestamp'].values.astype('datetime64[ns]')}
+
+        files = {}
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            sha256 = hashlib.sha256(array.tobytes()).hexdigest()
+            filename = location + '/' + name + '-' + sha256[:16] + '.npy'
+
+            # Unchanged arrays are already on disk
+            if not os.path.exists(folder + '/' + filename):
+                with open(folder + '/' + filename + '.tmp', 'wb') as handle:
+                    np.save(handle, array, allow_pickle=False)
+                os.replace(folder + '/' + filename + '.tmp', folder + '/' + filename)
+
+            files[name] = {'file': filename, 'sha256': sha256}
+
+        manifest['locations'][location] = {'rmse': float(evaluation[location][3]), 'arrays': files}
+
+    with open(folder + '/manifest.json.tmp', 'w') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    os.replace(folder + '/manifest.json.tmp', folder + '/manifest.json')
+
+    # Delete the files of the locations written that neither the new nor the previous manifest refer to
+    referenced = set(entry['file'] for version in [manifest, previous] for location in version['locations'].values()
+                     for entry in location['arrays'].values())
+
+    for location in evaluation.keys():
+        for filename in os.listdir(folder + '/' + location):
+            if filename.endswith('.npy') and location + '/' + filename not in referenced:
+                try:
+                    os.remove(folder + '/' + location + '/' + filename)
+                except OSError:
+                    pass # Still memory-mapped by a reader on Windows: deleted by a later write
+
+    return
@@ -1,134 +1,175 @@
 '''If you use Python 3.6, make sure you run <pip install jinja2==2.11> before running these imports.'''
 
 import os
-import pandas as pd
+import sys
+import json
+import argparse
+import base64
+import string
+import datetime as dt
 import streamlit as st
-import altair as alt
-from streamlit_folium import folium_static
-import folium
-import pydeck as pdk
-from utils_class import Utils
-from PIL import Image
+import streamlit.components.v1 as components
+from profiling import Profiler
+from instrumentation import timed, REGISTRY
 
+# Heavy modules (pandas, numpy, altair, folium, pydeck, PIL and utils_class) are imported by the functions that use them,
+# so that the header is rendered before they are loaded
 
-@st.cache(allow_output_mutation=True)
-def make_graphs(values, allow_output_mutation=True):
-    '''Create graphs for individual locations for Viz #1.'''
 
-    # Single location
-    def single_location_graph(location):
+# Popups show charts 400 px wide (Vega-Lite default): more than one value every 2 px can't be told apart
+POPUP_MAX_POINTS = 200
+
+
+def make_graph(location, to_plot):
+    '''Create graph of a single location for Viz #1.'''
+
+    import altair as alt
+
+    loc = location.capitalize()
+    graph = alt.Chart(data=to_plot, mark="line", title="Avg monthly rainfall for: "+loc).encode(
+                      x=alt.X('date'), 
+                      y=alt.Y('rain (mm)', scale=alt.Scale(domain=[0, 250])), 
+                      color='type', 
+                      strokeDash='type').properties(padding=0, autosize=alt.AutoSizeParams(
+    type='pad', contains='content'))
+
+    return graph
+
+
+@timed('chart_spec')
+def chart_spec(location, store, max_points=None):
+    '''Vega-Lite spec (JSON) of the graph of a single location for Viz #1, with at most "max_points" values
+       (see "Utils.select_lod"; all values if None).
+       Levels of detail and specs are built once per version of the data of the location and shared by all sessions.
+    '''
 
-        to_plot = values[location]
-        loc = location.capitalize()
-        graph = alt.Chart(data=to_plot, mark="line", title="Avg monthly rainfall for: "+loc).encode(
-                          x=alt.X('date'), 
-                          y=alt.Y('rain (mm)', scale=alt.Scale(domain=[0, 250])), 
-                          color='type', 
-                          strokeDash='type').properties(padding=0, autosize=alt.AutoSizeParams(
-        type='pad', contains='content'))
+    from utils_class import Utils
 
-        return graph
+    version = Utils.values_version(location)
 
-    # Produce graphs iteratively
-    output = {}
+    def build():
+        to_plot = store.series(location)
 
-    for location in values.keys():
-        
-        output[location] = single_location_graph(location)
+        if max_points is not None:
+            levels = Utils.derive('lod_levels', version, (location,), lambda: Utils.lod_levels(to_plot))
+            to_plot = Utils.select_lod(levels, max_points)
 
-    return output 
+        return make_graph(location, to_plot).to_json()
 
-    
-@st.cache(hash_funcs={folium.folium.Map: lambda _: None}, allow_output_mutation=True)
-def make_map1(values, coordinates):
+    return Utils.derive('chart_spec', version, (location, max_points), build)
+
+
+@timed('make_map1')
+def make_map1(store):
     '''Create map for Viz #1.'''
 
+    import folium
+
     # Create base map
     map1 = folium.Map(location=(51.65, 0.5), zoom_start=7, width='100%', height='100%')
 
     # Add location markers
-    for location in coordinates.keys():
-
-        lat = coordinates[location][0]
-        lon = coordinates[location][1]
+    for location, lat, lon in store.stations[['location','lat','lon']].itertuples(index=False):
 
         # Add location markers
         folium.CircleMarker(location=[lat,lon], radius=6, tooltip=location, color='red', fill=True, fill_color='red',
                             popup = folium.Popup(max_width='100%').add_child(
-                                            folium.features.VegaLite(make_graphs(values)[location])
+                                            folium.features.VegaLite(chart_spec(location, store, max_points=POPUP_MAX_POINTS))
                                             )).add_to(map1)
 
     return map1
 
 
-def prepare_data_for_map2(values, coordinates):
+@timed('map1_html')
+def map1_html(store):
+    '''Render the map of Viz #1 to static HTML (as folium_static does).
+       The HTML is rendered once per version of the store, and shared by all sessions.
+    '''
+
+    import folium
+    from utils_class import Utils
+
+    return Utils.derive('map1_html', store.version, (), lambda: folium.Figure().add_child(make_map1(store)).render())
+
+
+@timed('prepare_data_for_map2')
+def prepare_data_for_map2(store):
     '''Prepare data for Viz #2.
-       The input is a dictionary of dataframes and one of coordinates.
+       The input is the station x month store (see "Utils.read_store").
        The output is a dataframe with the following structure:
 
        date | location | lat | lon | rain (mm) | type
-    
-    '''
-
-
-    def generate_whole_month(year_month):
-        '''Generates a single df with all dates given 'yyyy-mm'
-        '''
 
-        df = pd.DataFrame({'date': pd.date_range(
-                                    start = pd.Timestamp(year_month),                        
-                                    end = pd.Timestamp(year_month) + pd.offsets.MonthEnd(0),
-                                    freq = 'D'
-                                    )
-            })
+       Every monthly value is expanded to one row per day of its month for all locations in one go:
+       rows are repeated by the number of days in their month and each repeat is offset by one day
+       from the first day of that month.
+    '''
 
-        return df
+    import numpy as np
+    import pandas as pd
 
+    # All locations in a single monthly df
+    monthly = store.monthly()
 
-    # Empty container
-    container = []
+    # First day of each month and number of days in it
+    month_start = monthly['date'].values.astype('datetime64[M]')
+    n_days = ((month_start + 1).astype('datetime64[D]') - month_start.astype('datetime64[D]')).astype(int)
 
-    # Iterate over dictionary of dfs
-    for location, dataframe in values.items():
-        df1 = dataframe
-        df1['y-m'] = df1['date'].dt.year.astype(str)+"-"+df1['date'].dt.month.astype(str)
+    # Repeat each monthly row once per day and compute the offset of each repeat within its month
+    rows = np.repeat(np.arange(len(monthly)), n_days)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(n_days) - n_days, n_days)
 
-        year_months = list(df1['date'].dt.year.astype(str)+"-"+df1['date'].dt.month.astype(str))
+    prepared_data = pd.DataFrame({
+                        'date': month_start.astype('datetime64[D]')[rows] + offsets.astype('timedelta64[D]'),
+                        'location': monthly['location'].values[rows],
+                        'lat': monthly['lat'].values[rows],
+                        'lon': monthly['lon'].values[rows],
+                        'rain': monthly['rain'].values[rows],
+                        'type': monthly['type'].values[rows]
+                    })
+    prepared_data['date'] = prepared_data['date'].astype('datetime64[ns]')
 
-        monthly_dfs= []
+    # Sort by date, keeping locations in input order within the same day
+    prepared_data = prepared_data.sort_values(by='date', ascending=True, kind='mergesort').reset_index(drop=True)
 
-        # For each 'YYYY-MM' string, create a new df with all days in that month and assign each day the average monthly rainfall 
-        for year_month in year_months:
+    return prepared_data
 
-            df2 = generate_whole_month(year_month)
-            df2['location'] = location
-            df2['lat'] = coordinates[location][0]
-            df2['lon'] = coordinates[location][1]
-            df2['rain (mm)'] = df1[df1['y-m']==year_month]['rain (mm)'].values[0]
-            df2['rain (mm)'] = df2['rain (mm)'].round(decimals=2)
-            df2['type'] = df1[df1['y-m']==year_month]['type'].values[0]
 
-            monthly_dfs.append(df2)
+@timed('map2_animation_html')
+def map2_animation_html(store, lat, lon, zoom, height):
+    '''Render Viz #2 as a standalone deck.gl page animated in the browser (templates/map2_animation.html).
+       The station x month matrix of the store is shipped once as binary buffers, and the month shown is selected on the GPU
+       by a DataFilterExtension: moving the slider doesn't rerun the app.
+       The HTML is rendered once per version of the store, and shared by all sessions.
+    '''
 
-        # This is for a single location
-        monthly_df = pd.concat(monthly_dfs, axis=0).reset_index(drop=True)
-        monthly_df = monthly_df[['date','location','lat','lon','rain (mm)','type']]
+    import numpy as np
+    from utils_class import Utils
 
-        # This is for all locations 
-        container.append(monthly_df)
+    def build():
+        payload = {'stations': store.stations['location'].tolist(),
+                   'lat': store.stations['lat'].tolist(),
+                   'lon': store.stations['lon'].tolist(),
+                   'first_month': str(store.months[0]),
+                   'n_months': len(store.months),
+                   'rain': base64.b64encode(store.rain.astype('<f4').tobytes()).decode('ascii'),
+                   'predicted': base64.b64encode(store.predicted.astype(np.uint8).tobytes()).decode('ascii'),
+                   'view': {'latitude': lat, 'longitude': lon, 'zoom': zoom}}
 
-    # Concat dfs for all locations
-    prepared_data = pd.concat(container, axis=0).sort_values(by='date', ascending=True).reset_index(drop=True)
+        with open('./templates/map2_animation.html', 'r') as f:
+            template = string.Template(f.read())
 
-    # Get rid of parentheses in rain column to avoid pydeck errors in rendering the correct column heights
-    prepared_data = prepared_data.rename(columns={'rain (mm)': 'rain'})
+        return template.substitute(payload=json.dumps(payload), height=height)
 
-    return prepared_data
+    return Utils.derive('map2_animation_html', store.version, (lat, lon, zoom, height), build)
 
 
+@timed('make_map2')
 def make_map2(data, lat, lon, zoom):
     '''Create map for Viz #2.'''
 
+    import pydeck as pdk
+
     my_layer = pdk.Layer(
                              "ColumnLayer",
                              data=data,
@@ -162,25 +203,51 @@ def make_map2(data, lat, lon, zoom):
     return map2
 
 
+@st.cache(allow_output_mutation=True)
+def get_forecast_service():
+    '''Create the forecast service once and share it (and its cache) across sessions.'''
+
+    from forecast_service import ForecastService
+
+    return ForecastService()
+
+
+@timed('make_forecast_graph')
+def make_forecast_graph(location, history, forecast):
+    '''Create graph of a what-if forecast, with the historic values of the same period.'''
+
+    import pandas as pd
+    import altair as alt
+
+    to_plot = pd.concat([history, forecast], axis=0)
+    graph = alt.Chart(data=to_plot, mark="line", title="What-if forecast for: "+location.capitalize()).encode(
+                      x=alt.X('date'),
+                      y=alt.Y('rain (mm)', scale=alt.Scale(domain=[0, 250])),
+                      color='type',
+                      strokeDash='type')
 
-#==== Initial set up common to all maps
-root = os.path.abspath(os.path.join("__file__", "../"))
-locations = ['cambridge', 'eastbourne', 'lowestoft', 'heathrow', 'manston', 'oxford']
-values = Utils.read_data_from_pickles(locations)
-coordinates = Utils.read_coordinates()
+    return graph
 
 
-#============================================= VIZ 1
-map1 = make_map1(values=values, coordinates=coordinates)
 
-#==== Create title and introductive text
-st.header("Digital Solutions for Civil Engineering: Machine Learning + interactive viz")
+def main(profiler):
+    '''Render the app. The header and introductive text are sent first, then each visualization loads what it needs.'''
 
-st.write("""
+    #==== Create title and introductive text
+    with profiler.phase('header'):
+        st.header("Digital Solutions for Civil Engineering: Machine Learning + interactive viz")
+
+        st.write("""
 by Francesco Castellani (mailto:fr.caste.eng@gmail.com)
 """)
 
-st.write("""
+    # The browser can show the page from here
+    profiler.mark('first_paint')
+
+    with profiler.phase('introduction'):
+        from PIL import Image
+
+        st.write("""
 ---
 This page shows an example of how data, predictions from a Machine Learning model, and interactive visualizations can live together in the same place. 
 
@@ -188,11 +255,11 @@ Digital framework used by this app:
 
 """) 
 
-# Add image
-image = Image.open('./images/Framework.png')
-st.image(image, caption='The digital framework used by this app. The boxes in grey represent future developments to enable real-time updates.')
+        # Add image
+        image = Image.open('./images/Framework.png')
+        st.image(image, caption='The digital framework used by this app. The boxes in grey represent future developments to enable real-time updates.')
 
-st.write("""
+        st.write("""
 ---
 This example uses monthly average rainfall data collected by the MetOffice for 6 locations in England:
 - Cambridge
@@ -210,40 +277,144 @@ https://www.metoffice.gov.uk/research/climate/maps-and-data/historic-station-dat
 ---
 """)
 
-hide_menu_style = """
+        hide_menu_style = """
         <style>
         #MainMenu {visibility: hidden;}
         </style>
         """
-st.markdown(hide_menu_style, unsafe_allow_html=True)
+        st.markdown(hide_menu_style, unsafe_allow_html=True)
+
+
+    #==== Initial set up common to all maps
+    with profiler.phase('data'):
+        from utils_class import Utils
 
-st.header("Viz #1: interactive map showing rainfall time series")
-st.write("""
+        locations = ['cambridge', 'eastbourne', 'lowestoft', 'heathrow', 'manston', 'oxford']
+        # Historic and predicted values of all locations: one station x month matrix, shared by all sessions
+        store = Utils.read_store(locations)
+
+
+    #============================================= VIZ 1
+    with profiler.phase('viz1'):
+        st.header("Viz #1: interactive map showing rainfall time series")
+        st.write("""
 Click on each station to visualize the historic rainfall time series (in blue) and the predicted values (in orange). 
 """)
 
-# Render map 1 on the app
-folium_static(map1, width=800, height=600)
-st.write("""---""")  
+        # Render map 1 on the app (same size as folium_static)
+        components.html(map1_html(store), width=800, height=610)
+        st.write("""---""")  
 
 
-#============================================= VIZ 2
-st.header("Viz #2: interactive map showing rainfall as bars")
-st.write("""
+    #============================================= VIZ 2
+    with profiler.phase('viz2'):
+        st.header("Viz #2: interactive map showing rainfall as bars")
+        st.write("""
 Move the time slider to visualize how the rainfall values change from one location to another and in relation to each other. 
 """)
 
-# Add time slider
-start_date_str = '2000-01-15'
-end_date_str = '2021-09-15'
-format = 'DD MMM YYYY' 
-selected_date = Utils.add_time_slider(format=format, start_date_str=start_date_str, end_date_str=end_date_str)
+        central_location = [51.65, 0.5]
+
+        # The slider either reruns the app to send the month selected (server), or runs in the browser on data sent once
+        mode = st.radio('Time slider', ['Server: select a date', 'Browser: play or scrub through all months'])
+
+        if mode.startswith('Server'):
+            from streamlit_folium import folium_static
+
+            # Add time slider
+            start_date_str = '2000-01-15'
+            end_date_str = '2021-09-15'
+            format = 'DD MMM YYYY' 
+            selected_date = Utils.add_time_slider(format=format, start_date_str=start_date_str, end_date_str=end_date_str)
+
+            # Values of all locations at the month selected
+            data = store.at_month(selected_date)
+
+            # Add map
+            map2 = make_map2(data=data, lat=central_location[0], lon=central_location[1], zoom=7)
+            folium_static(map2, width=800, height=600)
+
+        else:
+
+            components.html(map2_animation_html(store, lat=central_location[0], lon=central_location[1], zoom=7, height=600),
+                            width=800, height=660)
+
+
+    #============================================= WHAT-IF FORECASTS
+    # Only shown when models have been exported for the inference runtime (see models/README.md)
+    if all(os.path.exists('./models/'+location+'_inference.npz') for location in locations):
+
+        with profiler.phase('what_if'):
+            st.write("""---""")
+            st.header("What-if: forecast from any month")
+            st.write("""
+Pick a station, the first month to forecast and the number of months: the forecast is computed on demand from the previous 10 years of data.
+""")
+
+            forecast_location = st.selectbox('Station', locations)
+            origin = st.slider('First month to forecast', min_value=dt.date(2010,1,15), max_value=dt.date(2021,10,15), value=dt.date(2019,10,15), format='MMM YYYY')
+            horizon = st.slider('Months to forecast', min_value=1, max_value=24, value=24)
+
+            # Inputs the service can't forecast (eg, not enough data before the first month, no exported model) are reported
+            try:
+                forecast = get_forecast_service().forecast([(forecast_location, origin, horizon)])[0]
+            except (ValueError, OSError) as e:
+                st.warning('No forecast for these inputs: '+str(e))
+                forecast = None
+
+            if forecast is not None:
+                # Historic values over the same period, when available
+                clean = Utils.read_clean_data(forecast_location)
+                history = clean[clean['timestamp'].isin(forecast['date'])].rename(columns={'timestamp': 'date', 'rain_mm': 'rain (mm)'})
+                history = history[['date','rain (mm)']].assign(type='historic')
+
+                st.altair_chart(make_forecast_graph(forecast_location, history, forecast), use_container_width=True)
+
+    return
+
+
+#==== Run the app
+# Streamlit runs this file as __main__ on every rerun; importing it (eg, from benchmarks) doesn't render anything.
+# Options are passed after "--": streamlit run dashboard.py -- --profile --metrics-port 9100
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Rainfall dashboard.')
+    parser.add_argument('--profile', action='store_true', help='append the timing of each phase of every run to results/profiling/startup.jsonl')
+    parser.add_argument('--debug', action='store_true', help='record the hot-path timings with memory tracing, and open the debug panel by default')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve the hot-path timings in the Prometheus text format on localhost:<port>/metrics')
+    parser.add_argument('--metrics-log', default=None, help='append a snapshot of the hot-path timings to this JSON lines file after every run')
+    args, _ = parser.parse_known_args(sys.argv[1:])
+
+    profiler = Profiler(enabled=args.profile)
+
+    # Hot-path instrumentation (see instrumentation.py): the registry is shared by all sessions of the process,
+    # so it is only set up by the command line, once per process. Memory is only traced with --debug, as tracing slows down the app
+    if not REGISTRY.enabled:
+        REGISTRY.enable(args.debug or args.metrics_port is not None or args.metrics_log is not None, trace_memory=args.debug)
+
+        # Served from the first run only: a port that can't be bound is reported once, not retried on every rerun
+        if args.metrics_port is not None:
+            try:
+                REGISTRY.serve(args.metrics_port)
+            except OSError as e:
+                print('Metrics endpoint unavailable on port '+str(args.metrics_port)+': '+str(e))
+
+    # The debug panel only displays the timings, for this session
+    debug = REGISTRY.enabled and st.sidebar.checkbox('Debug: hot-path timings', value=args.debug)
+
+    with timed('rerun'):
+        main(profiler)
+
+    if profiler.enabled:
+        profiler.write('./results/profiling/startup.jsonl')
+        st.sidebar.write('Profiling (seconds)')
+        st.sidebar.json(profiler.report())
+
+    if args.metrics_log is not None:
+        REGISTRY.write_jsonl(args.metrics_log)
 
-# Get prepared data and filer by date selected
-prepared_data = prepare_data_for_map2(values=values, coordinates=coordinates)
-data = prepared_data[prepared_data['date'] == pd.to_datetime(selected_date)]
+    if debug:
+        import pandas as pd
 
-# Add map
-central_location = [51.65, 0.5]
-map2 = make_map2(data=data, lat=central_location[0], lon=central_location[1], zoom=7)
-folium_static(map2, width=800, height=600)  
\ No newline at end of file
+        st.sidebar.write('Hot-path timings since the process started (all sessions)')
+        st.sidebar.dataframe(pd.DataFrame.from_dict(REGISTRY.snapshot(), orient='index'))
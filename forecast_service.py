@@ -0,0 +1,96 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from utils_class import Utils
+from inference_class import Inference
+
+
+class ForecastService:
+    '''In-process forecast service for what-if forecasts.
+       Models exported for the NumPy inference runtime are loaded once (and reloaded only when their file changes).
+       Requests are (station, origin, horizon): forecast "horizon" months starting from the month of "origin",
+       using the n_past months before it as input. Results are kept in a bounded LRU cache keyed on the model version
+       and the input window, so repeated requests are served without running the network.
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def input_window(self, station, origin, n_past):
+        '''Return the n_past monthly values (in mm) before the month of "origin".'''
+
+        data = Utils.read_clean_data(station)
+        origin_month = np.datetime64(pd.Timestamp(origin), 'M')
+
+        months = data['timestamp'].values.astype('datetime64[M]')
+        window = data['rain_mm'].values[months < origin_month][-n_past:]
+
+        if len(window) < n_past:
+            raise ValueError('Not enough data before '+str(origin_month)+' for '+station+': '+str(n_past)+' months needed')
+
+        return window
+
+
+    def forecast(self, requests):
+        '''Serve a batch of requests: a list of (station, origin date, horizon) tuples.
+           Cache misses are computed together (one batched forward pass per network).
+           Returns a list of dfs, one per request, with the structure: date | rain (mm) | type
+        '''
+
+        keys, windows, results = [], {}, {}
+
+        for station, origin, horizon in requests:
+            model = Utils.read_inference_models([station])[station]
+
+            if horizon > model.n_future:
+                raise ValueError('Horizon longer than the model output for '+station+': '+str(model.n_future)+' months max')
+
+            window = self.input_window(station, origin, model.n_past)
+            version = Utils.artifact_version('./models/'+station+'_inference.npz')
+            key = (station, version, hashlib.sha256(window.tobytes()).hexdigest())
+
+            keys.append((key, origin, horizon))
+
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    results[key] = self.cache[key]
+                    self.hits += 1
+                    continue
+
+            windows.setdefault(station, {})[key] = window
+
+        # Compute all misses in one batched call
+        if len(windows) > 0:
+            models = Utils.read_inference_models(list(windows.keys()))
+            series = {station: np.stack(list(station_windows.values())) for station, station_windows in windows.items()}
+            forecasts = Inference.forecast_many(models, series)
+
+            with self.lock:
+                for station, station_windows in windows.items():
+                    for key, predicted in zip(station_windows.keys(), forecasts[station]):
+                        results[key] = predicted
+                        self.cache[key] = predicted
+                        self.misses += 1
+
+                # Evict least recently used
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+
+        # Outputs in the order of the requests
+        outputs = []
+
+        for key, origin, horizon in keys:
+            timeline = (np.datetime64(pd.Timestamp(origin), 'M') + np.arange(0, horizon)).astype('datetime64[D]') + np.timedelta64(14, 'D')
+            outputs.append(pd.DataFrame({'date': timeline.astype('datetime64[ns]'),
+                                         'rain (mm)': results[key][:horizon],
+                                         'type': 'predicted'}))
+
+        return outputs
@@ -0,0 +1,217 @@
+import os
+import json
+import numpy as np
+
+
+def sigmoid(x):
+    '''Logistic sigmoid.'''
+
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def hard_sigmoid(x):
+    '''Piecewise linear approximation of the sigmoid, as defined by Keras.'''
+
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+# Activations used by Keras layers, by name
+ACTIVATIONS = {'sigmoid': sigmoid,
+               'hard_sigmoid': hard_sigmoid,
+               'tanh': np.tanh,
+               'relu': lambda x: np.maximum(x, 0.0),
+               'linear': lambda x: x}
+
+
+# Shared weights (eg, of a global model) are loaded once per file version
+_networks = {}
+
+
+class Inference:
+    '''Forward pass of an exported Keras LSTM regressor using NumPy only (no TensorFlow).
+       Models are exported by "export_inference_weights" in scripts/2.predictions.py to one .npz file per location,
+       containing the weights of each layer, the parameters of the standard scaler and the window sizes.
+       Dropout layers are not exported as they are inactive at inference time.
+    '''
+
+    def __init__(self, network, mean, scale, n_past, n_future, station=None, n_stations=None):
+        # "network" is shared by all locations of a global model: (weights filepath, layers, weights)
+        self.network = network
+        self.mean = mean
+        self.scale = scale
+        self.n_past = n_past
+        self.n_future = n_future
+        self.station = station
+        self.n_stations = n_stations
+
+
+    def load(filepath):
+        '''Load an exported model from .npz file.
+           Models trained as a global model (shared by all locations) point to a single file with the shared weights.
+        '''
+
+        with np.load(filepath, allow_pickle=False) as data:
+            spec = json.loads(str(data['location_spec']))
+            mean, scale = data['mean'], data['scale']
+
+            weights_filepath = filepath
+            if spec.get('weights') is not None:
+                weights_filepath = os.path.join(os.path.dirname(filepath), spec['weights'])
+
+        return Inference(Inference.load_network(weights_filepath), mean, scale, spec['n_past'], spec['n_future'],
+                         spec.get('station'), spec.get('n_stations'))
+
+
+    def load_network(filepath):
+        '''Load the layers and weights of a network from .npz file, once per file version.'''
+
+        filepath = os.path.abspath(filepath)
+        key = (filepath, os.stat(filepath).st_mtime_ns)
+
+        if key not in _networks:
+            with np.load(filepath, allow_pickle=False) as data:
+                network = json.loads(str(data['network_spec']))
+                weights = [[data['w_'+str(i)+'_'+str(j)] for j in range(0, layer['n_weights'])] for i, layer in enumerate(network['layers'])]
+
+            _networks[key] = (filepath, network['layers'], weights)
+
+        return _networks[key]
+
+
+    def predict(self, past, stations=None):
+        '''Run the network on a batch of scaled past windows: (N, n_past, 1) -> (N, n_future).
+           For global models, "stations" gives the station index of each window (defaults to the station of this model),
+           so that windows of several locations can go through the network in a single pass.
+        '''
+
+        x = np.asarray(past, dtype=np.float32)
+
+        # Global models expect a one-hot station ID on every time step
+        if self.n_stations is not None:
+            if stations is None:
+                stations = np.full(x.shape[0], self.station)
+            one_hot = np.zeros((x.shape[0], x.shape[1], self.n_stations), dtype=x.dtype)
+            one_hot[np.arange(x.shape[0]), :, stations] = 1
+            x = np.concatenate([x, one_hot], axis=2)
+
+        _, layers, network_weights = self.network
+
+        for layer, weights in zip(layers, network_weights):
+
+            if layer['type'] == 'lstm':
+                x = lstm_forward(x, *weights, layer)
+
+            elif layer['type'] == 'bidirectional':
+                forward = lstm_forward(x, *weights[0:3], layer)
+                backward = lstm_forward(x[:, ::-1, :], *weights[3:6], layer)
+
+                # Backward outputs are put back in chronological order
+                if layer['return_sequences']:
+                    backward = backward[:, ::-1, :]
+
+                x = merge(forward, backward, layer['merge_mode'])
+
+            elif layer['type'] == 'dense':
+                x = ACTIVATIONS[layer['activation']](x @ weights[0] + weights[1])
+
+        return x
+
+
+    def forecast(self, series):
+        '''Forecast the next n_future values (in mm) after each series of past values (in mm).
+           "series" is a 1D array (one forecast) or a 2D array (one forecast per row); only the last n_past values are used.
+           Returns a 2D array: (N, n_future).
+        '''
+
+        series = np.atleast_2d(np.asarray(series, dtype=np.float64))[:, -self.n_past:]
+
+        # Scale as in training, then inverse the scaling of the predictions
+        scaled = (series - self.mean) / self.scale
+        predictions = self.predict(scaled[:, :, np.newaxis])
+
+        return predictions * self.scale + self.mean
+
+
+    def forecast_many(models, series):
+        '''Forecast several locations at once. "models" and "series" are dictionaries keyed by location.
+           Locations sharing the same network (global model) are run through it in a single batched pass.
+           Returns a dictionary of 2D arrays: (N, n_future) for each location.
+        '''
+
+        # Group locations by network
+        groups = {}
+        for location in models.keys():
+            groups.setdefault(models[location].network[0], []).append(location)
+
+        forecasts = {}
+
+        for filepath, locations in groups.items():
+
+            # Scale the inputs of each location with its own scaler and stack them
+            scaled, stations, sizes = [], [], []
+            for location in locations:
+                model = models[location]
+                x = np.atleast_2d(np.asarray(series[location], dtype=np.float64))[:, -model.n_past:]
+                scaled.append((x - model.mean) / model.scale)
+                stations.append(np.full(x.shape[0], model.station if model.station is not None else 0))
+                sizes.append(x.shape[0])
+
+            model = models[locations[0]]
+            predictions = model.predict(np.concatenate(scaled, axis=0)[:, :, np.newaxis], np.concatenate(stations))
+
+            # Split per location and inverse the scaling
+            for location, predicted in zip(locations, np.split(predictions, np.cumsum(sizes)[:-1])):
+                forecasts[location] = predicted * models[location].scale + models[location].mean
+
+        return forecasts
+
+
+def lstm_forward(x, kernel, recurrent_kernel, bias, layer):
+    '''Forward pass of a Keras LSTM layer over a batch of sequences: (N, T, features) -> (N, T, units) or (N, units).
+       Keras stores the gates in the order: input, forget, cell, output.
+    '''
+
+    units = recurrent_kernel.shape[0]
+    activation = ACTIVATIONS[layer['activation']]
+    recurrent_activation = ACTIVATIONS[layer['recurrent_activation']]
+
+    # Input contributions for all time steps at once
+    x_proj = x @ kernel + bias
+
+    h = np.zeros((x.shape[0], units), dtype=x_proj.dtype)
+    c = np.zeros((x.shape[0], units), dtype=x_proj.dtype)
+    outputs = []
+
+    for t in range(0, x.shape[1]):
+        z = x_proj[:, t, :] + h @ recurrent_kernel
+
+        i = recurrent_activation(z[:, :units])
+        f = recurrent_activation(z[:, units:2*units])
+        g = activation(z[:, 2*units:3*units])
+        o = recurrent_activation(z[:, 3*units:])
+
+        c = f * c + i * g
+        h = o * activation(c)
+
+        if layer['return_sequences']:
+            outputs.append(h)
+
+    if layer['return_sequences']:
+        return np.stack(outputs, axis=1)
+
+    return h
+
+
+def merge(forward, backward, merge_mode):
+    '''Merge the outputs of the two directions of a Keras Bidirectional layer.'''
+
+    if merge_mode == 'concat':
+        return np.concatenate([forward, backward], axis=-1)
+    if merge_mode == 'sum':
+        return forward + backward
+    if merge_mode == 'mul':
+        return forward * backward
+    if merge_mode == 'ave':
+        return (forward + backward) / 2
+
+    raise ValueError('Unsupported merge mode: '+str(merge_mode))
@@ -0,0 +1,234 @@
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class Registry:
+    '''Process-wide registry of the timings of the hot path of the dashboard, shared by all sessions.
+       For each name, it records the number of calls, the wall time (total and max), the peak memory allocated
+       during a call (if traced, see "enable") and the cache hits and misses of the artifacts and derived objects of utils_class.
+       Nothing is recorded while it is disabled, and timed functions only pay for one attribute check.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.server = None
+
+
+    def enable(self, enabled=True, trace_memory=False):
+        '''Start (or stop) recording. Memory is only traced (with tracemalloc) if "trace_memory" is True,
+           as tracing slows down every allocation: keep it for debugging.
+        '''
+
+        self.enabled = enabled
+        trace_memory = enabled and trace_memory
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        return
+
+
+    def entry(self, name):
+        '''Stats of a name (created on first use). Call with the lock held.'''
+
+        if name not in self.stats:
+            self.stats[name] = {'calls': 0, 'seconds_total': 0.0, 'seconds_max': 0.0, 'peak_memory_bytes': 0,
+                                'cache_hits': 0, 'cache_misses': 0}
+
+        return self.stats[name]
+
+
+    def record(self, name, seconds, peak_memory):
+        '''Record a timed call.'''
+
+        with self.lock:
+            entry = self.entry(name)
+            entry['calls'] += 1
+            entry['seconds_total'] += seconds
+            entry['seconds_max'] = max(entry['seconds_max'], seconds)
+            entry['peak_memory_bytes'] = max(entry['peak_memory_bytes'], peak_memory)
+
+        return
+
+
+    def cache(self, name, hit):
+        '''Record a cache hit (or miss).'''
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.entry(name)['cache_hits' if hit else 'cache_misses'] += 1
+
+        return
+
+
+    def snapshot(self):
+        '''Return a copy of the stats, keyed by name.'''
+
+        with self.lock:
+            return {name: dict(entry) for name, entry in self.stats.items()}
+
+
+    def reset(self):
+        '''Drop all the stats recorded.'''
+
+        with self.lock:
+            self.stats = {}
+
+        return
+
+
+    def prometheus(self):
+        '''Export the stats in the Prometheus text format.'''
+
+        metrics = [('calls', 'dashboard_calls_total', 'counter', 'Number of calls.'),
+                   ('seconds_total', 'dashboard_seconds_total', 'counter', 'Wall time spent, in seconds.'),
+                   ('seconds_max', 'dashboard_seconds_max', 'gauge', 'Longest call, in seconds.'),
+                   ('peak_memory_bytes', 'dashboard_peak_memory_bytes', 'gauge', 'Largest peak of memory allocated during a call, in bytes.'),
+                   ('cache_hits', 'dashboard_cache_hits_total', 'counter', 'Number of cache hits.'),
+                   ('cache_misses', 'dashboard_cache_misses_total', 'counter', 'Number of cache misses.')]
+
+        stats = self.snapshot()
+        lines = []
+
+        for key, metric, kind, description in metrics:
+            lines.append('# HELP ' + metric + ' ' + description)
+            lines.append('# TYPE ' + metric + ' ' + kind)
+            for name in sorted(stats.keys()):
+                lines.append(metric + '{name="' + name + '"} ' + repr(stats[name][key]))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write_jsonl(self, filepath):
+        '''Append a snapshot of the stats to a JSON lines file.'''
+
+        with open(filepath, 'a') as handle:
+            handle.write(json.dumps({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stats': self.snapshot()}) + '\n')
+
+        return
+
+
+    def serve(self, port, host='127.0.0.1'):
+        '''Serve the Prometheus text export on http://host:port/metrics from a background thread (once per process).'''
+
+        with self.lock:
+            if self.server is not None:
+                return self.server
+
+            registry = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+
+                    body = registry.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    return
+
+            class Server(ThreadingMixIn, HTTPServer):
+                daemon_threads = True
+
+            self.server = Server((host, port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+            return self.server
+
+
+# Registry of this process
+REGISTRY = Registry()
+
+
+class timed:
+    '''Time a function (as a decorator) or a block of code (as a context manager) in the registry, under "name".
+       Timers can be nested: the peak memory of a call includes the calls it makes.
+       tracemalloc.reset_peak (Python 3.9+) isolates the peak of each call; on older versions the peak is the
+       largest allocation since the call started or before it, so it is an upper bound.
+    '''
+
+    def __init__(self, name, registry=REGISTRY):
+        self.name = name
+        self.registry = registry
+
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.registry.enabled:
+                return function(*args, **kwargs)
+
+            with timed(self.name, self.registry):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+
+    def __enter__(self):
+        self.active = self.registry.enabled
+        self.memory = self.active and tracemalloc.is_tracing()
+
+        if self.memory:
+            # Timers running in this thread
+            stack = getattr(self.registry.local, 'stack', None)
+            if stack is None:
+                stack = self.registry.local.stack = []
+
+            current, peak = tracemalloc.get_traced_memory()
+
+            # The enclosing call keeps the peak reached so far, before it is reset for this call
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+            self.memory_start = current
+            self.peak = current
+            stack.append(self)
+
+        self.start = time.perf_counter()
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.active:
+            return False
+
+        seconds = time.perf_counter() - self.start
+        peak_memory = 0
+
+        # Tracing may have been switched off by another session in the meantime
+        stack = getattr(self.registry.local, 'stack', [])
+        if self.memory and len(stack) > 0 and stack[-1] is self:
+            if tracemalloc.is_tracing():
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            stack.pop()
+
+            # The enclosing call includes the peak of this call
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+
+            peak_memory = self.peak - self.memory_start
+
+        self.registry.record(self.name, seconds, peak_memory)
+
+        return False
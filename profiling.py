@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from contextlib import contextmanager
+
+
+# Modules imported by the dashboard, from the lightest to the heaviest dependency
+DASHBOARD_MODULES = ['streamlit', 'numpy', 'pandas', 'altair', 'folium', 'streamlit_folium', 'pydeck', 'PIL.Image',
+                     'utils_class', 'dashboard']
+
+
+class Profiler:
+    '''Per-phase timing of a run of the dashboard.
+       Phases record their wall time (in seconds, from the creation of the profiler) and the number of modules
+       imported while they run, so that the cost of lazy imports shows up in the phase that triggers them.
+       Marks record single events, eg the first paint (the header sent to the browser).
+       When disabled, phases and marks do nothing.
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.phases = []
+        self.marks = {}
+
+
+    @contextmanager
+    def phase(self, name):
+        '''Time the code run inside a "with" block as a phase.'''
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        n_modules = len(sys.modules)
+
+        try:
+            yield
+        finally:
+            self.phases.append({'phase': name,
+                                'start': start - self.start,
+                                'duration': time.perf_counter() - start,
+                                'modules_imported': len(sys.modules) - n_modules})
+
+
+    def mark(self, name):
+        '''Record the time of an event.'''
+
+        if self.enabled:
+            self.marks[name] = time.perf_counter() - self.start
+
+
+    def report(self):
+        '''Return the timings as a dictionary.'''
+
+        return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'total': time.perf_counter() - self.start,
+                'marks': self.marks,
+                'phases': self.phases}
+
+
+    def write(self, filepath):
+        '''Append the report to a JSON lines file (one line per run: the first run of a process is the cold start).'''
+
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+
+        with open(filepath, 'a') as handle:
+            handle.write(json.dumps(self.report()) + '\n')
+
+        return
+
+
+def import_time(module, cwd=None):
+    '''Time the import of a module (and of everything it imports) in a fresh interpreter, in seconds.'''
+
+    code = 'import time; start = time.perf_counter(); import ' + module + '; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True, check=True).stdout
+
+    return float(output.strip().splitlines()[-1])
+
+
+def import_times(modules=DASHBOARD_MODULES, repeats=3, cwd=None):
+    '''Cold import time of each module (best of "repeats" fresh interpreters), in seconds.'''
+
+    return {module: min(import_time(module, cwd) for i in range(0, repeats)) for module in modules}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Cold import time of the modules used by the dashboard.')
+    parser.add_argument('--modules', nargs='+', default=DASHBOARD_MODULES, help='modules to import')
+    parser.add_argument('--repeats', type=int, default=3, help='fresh interpreters per module (the best time is kept)')
+    parser.add_argument('--output', default=None, help='JSON file to save the timings to')
+    args = parser.parse_args()
+
+    # Modules of the app are imported from the folder of this file
+    times = import_times(args.modules, args.repeats, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    for module, seconds in sorted(times.items(), key=lambda item: item[1], reverse=True):
+        print('{:<20} {:>8.3f} s'.format(module, seconds))
+
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(times, handle, indent=2)
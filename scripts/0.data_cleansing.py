@@ -1,82 +1,168 @@
 import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
 import pandas as pd
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from script_utils import write_atomic
 
 
-def extract_values(line):
-    '''Extract numerical values from text lines.'''
+def file_to_df(filepath):
+    '''Turn text file into pandas df.
+       The whole file is parsed in one pass as whitespace-separated columns, then the rain column is cleaned
+       and the timestamps are built from the year and month columns, without iterating over lines.
+    '''
 
-    # Split line
-    line_split = line.split('   ')
+    # Identify location
+    location = filepath.split('/')[-1].split('.')[0]
 
-    # Extract clean items
-    clean = [ei for e in line_split for ei in e.strip().split()]
+    # Read year, month and rain columns as text. Trailing comments (eg, "Provisional") end up in unused columns
+    result = pd.read_csv(filepath, sep=r'\s+', skiprows=2, header=None, names=range(0, 12), dtype=str, encoding='utf-8')
+    result = result[[0, 1, 5]]
+    result.columns = ['year','month','rain_mm']
 
-    # Special characters
-    special_chars = ["$", "@", "#", "&", "%", "*", "-", "~", "?", "/", "!"]
+    # Missing values ("---") become 0, then flags attached to values (eg, "*" for estimated, "#" for automatic) are deleted
+    special_chars = r'[$@#&%*\-~?/!]'
+    result.rain_mm = result.rain_mm.str.replace('---', '0.00', regex=False).str.replace(special_chars, '', regex=True)
 
-    # Year
-    year = int(clean[0])
+    # Format data type
+    result.year = result.year.astype(int)
+    result.month = result.month.astype(int)
+    result.rain_mm = result.rain_mm.astype(float)
 
-    # Month
-    month = int(clean[1])
+    # Add timestamp
+    result['timestamp'] = pd.to_datetime(pd.DataFrame({'year': result.year, 'month': result.month, 'day': 15}))
+    result['location'] = location
+    result = result[['timestamp','year','month','location','rain_mm']]
 
-    # Rain
-    rain = clean[5].replace(" ---","0.00").replace("---","0.00").replace("--- ","0.00")
-    rain = "".join([k for k in rain if k not in special_chars]) # Delete special characters
+    return result
 
 
-    return [year, month, rain]
+def file_signature(filepath, previous=None):
+    '''Return the mtime and content hash of a file.
+       The hash of "previous" (a signature from an earlier run) is reused when the mtime has not changed.
+    '''
 
+    mtime = os.stat(filepath).st_mtime
 
-def file_to_df(filepath):
-    '''Turn text file into pandas df.'''
+    if previous is not None and previous['mtime'] == mtime:
+        return previous
 
-    # Identify location
-    location = filepath.split('/')[-1].split('.')[0]
+    with open(filepath, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
 
-    with open(filepath,'rt',encoding='utf-8') as file:
-        lines = file.readlines()[2:]
+    return {'mtime': mtime, 'sha256': sha256}
 
-        # Create empty final df
-        result = pd.DataFrame(index=range(0, len(lines)), columns=['year','month','rain_mm'])
 
-        # Iterate over lines of text
-        for i, line in enumerate(lines):
+def ingest_file(filepath, output_folder):
+    '''Parse a single raw station file and write its clean csv.'''
 
-            # Generate list of values and append it to df
-            to_append = extract_values(line)
-            result.iloc[i] = to_append
+    result = file_to_df(filepath=filepath)
+    location = result['location'].iloc[0] if len(result) > 0 else filepath.split('/')[-1].split('.')[0]
 
-    # Format data type
-    result.year = result.year.astype(int)
-    result.month = result.month.astype(int)
-    result.rain_mm = result.rain_mm.astype(float)
+    output = output_folder + '/' + location.lower() + '.csv'
+    write_atomic(output, result.to_csv)
 
-    # Add timestamp
-    result['timestamp'] = result.apply(lambda row: datetime.strptime(f"{int(row.year)}-{int(row.month)}-15", '%Y-%m-%d'), axis=1)
-    result['location'] = location
-    result = result[['timestamp','year','month','location','rain_mm']]
+    return output
 
-    return result
 
+def append_new_months(filepath, output_folder):
+    '''Parse a single raw station file and append to its clean csv only the months after the last month already in it.
+       Rows already in the clean csv are left as they are (revised values are picked up by a full ingestion).
+       The csv is the same as the one written by "ingest_file" over the whole file. If there is no clean csv yet, the whole file is ingested.
+       Returns the clean csv and the rows appended.
+    '''
+
+    result = file_to_df(filepath=filepath)
+    location = result['location'].iloc[0] if len(result) > 0 else filepath.split('/')[-1].split('.')[0]
+    output = output_folder + '/' + location.lower() + '.csv'
+
+    if not os.path.exists(output):
+        write_atomic(output, result.to_csv)
+        return output, result
+
+    # Only the last timestamp and the number of rows of the clean csv are needed
+    existing = pd.read_csv(output, usecols=['timestamp'], parse_dates=['timestamp'])
+    new_rows = result[result['timestamp'] > existing['timestamp'].max()]
+
+    if len(new_rows) == 0:
+        return output, new_rows
+
+    # Continue the index of the clean csv, then append to a copy of it
+    new_rows = new_rows.set_index(pd.RangeIndex(len(existing), len(existing) + len(new_rows)))
+
+    def append(tmp_filepath):
+        shutil.copyfile(output, tmp_filepath)
+        with open(tmp_filepath, 'a') as f:
+            new_rows.to_csv(f, header=False)
+
+    write_atomic(output, append)
+
+    return output, new_rows
+
+
+def ingest_bulk(root, n_workers=None, force=False):
+    '''Clean every raw station file in data/raw/ and write the results to data/clean/.
+       Files are parsed in parallel by a pool of processes ("n_workers", defaults to the number of CPUs).
+       Only files whose content changed since the last run are processed again, unless "force" is True.
+       The state of the last run is stored in data/clean/.ingestion_state.json.
+    '''
+
+    raw_folder = root + '/data/raw'
+    output_folder = root + '/data/clean'
+    state_filepath = output_folder + '/.ingestion_state.json'
+
+    # Previous state: {raw filename: {'mtime': ..., 'sha256': ...}}
+    state = {}
+    if os.path.exists(state_filepath):
+        with open(state_filepath, 'r') as f:
+            state = json.load(f)
+
+    # Identify files that changed since the last run
+    signatures = {}
+    to_process = []
+
+    for filepath in sorted(glob.glob(raw_folder + '/*.txt')):
+        filename = os.path.basename(filepath)
+        previous = state.get(filename)
+        signatures[filename] = file_signature(filepath, previous)
+
+        output = output_folder + '/' + filename.split('.')[0].lower() + '.csv'
+        unchanged = previous is not None and previous['sha256'] == signatures[filename]['sha256'] and os.path.exists(output)
+
+        if force or not unchanged:
+            to_process.append(filepath)
+
+    print('Ingesting '+str(len(to_process))+' of '+str(len(signatures))+' raw files')
+
+    # Parse in parallel
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(ingest_file, filepath, output_folder): filepath for filepath in to_process}
+
+        for future in as_completed(futures):
+            print('Written: '+future.result())
+
+    # Store new state only once all files have been written
+    def write_state(tmp_filepath):
+        with open(tmp_filepath, 'w') as f:
+            json.dump(signatures, f, indent=2, sort_keys=True)
+
+    write_atomic(state_filepath, write_state)
+
+    return to_process
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Clean raw MetOffice station files.')
+    parser.add_argument('--workers', type=int, default=None, help='number of parallel processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='process all files, including unchanged ones')
+    args = parser.parse_args()
+
+    # Set root dir
+    root = os.path.abspath(os.path.join("__file__", "../../"))
 
-# Set root dir
-root = os.path.abspath(os.path.join("__file__", "../../"))
-
-# Read data
-# Cleaned
-cambridge = file_to_df(filepath = root + '/data/raw/Cambridge.txt')
-eastbourne = file_to_df(filepath = root + '/data/raw/Eastbourne.txt')
-heathrow = file_to_df(filepath = root + '/data/raw/Heathrow.txt')
-lowestoft = file_to_df(filepath = root + '/data/raw/Lowestoft.txt')
-manston = file_to_df(filepath = root + '/data/raw/Manston.txt')
-oxford = file_to_df(filepath = root + '/data/raw/Oxford.txt')
-
-# Dump data
-cambridge.to_csv(root + '/data/clean/cambridge.csv')
-eastbourne.to_csv(root + '/data/clean/eastbourne.csv')
-heathrow.to_csv(root + '/data/clean/heathrow.csv')
-lowestoft.to_csv(root + '/data/clean/lowestoft.csv')
-manston.to_csv(root + '/data/clean/manston.csv')
-oxford.to_csv(root + '/data/clean/oxford.csv')
+    # Clean every raw file and dump data
+    ingest_bulk(root, n_workers=args.workers, force=args.force)
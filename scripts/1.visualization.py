@@ -1,7 +1,6 @@
 import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+import argparse
 
 
 def slice_data(data, cutoff):
@@ -12,65 +11,47 @@ def slice_data(data, cutoff):
     return data
 
 
-# Set root dir
-root = os.path.abspath(os.path.join("__file__", "../.."))
-
-# Read clean data
-cutoff = '2000-01-15'
-cambridge = slice_data(pd.read_csv(root + '/data/clean/cambridge.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff) 
-eastbourne = slice_data(pd.read_csv(root + '/data/clean/eastbourne.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff)
-heathrow = slice_data(pd.read_csv(root + '/data/clean/heathrow.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff)
-lowestoft = slice_data(pd.read_csv(root + '/data/clean/lowestoft.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff)
-manston = slice_data(pd.read_csv(root + '/data/clean/manston.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff)
-oxford = slice_data(pd.read_csv(root + '/data/clean/oxford.csv', parse_dates=['timestamp'], index_col=0),cutoff=cutoff)
-
-
-# Plot
-plt.figure(figsize=(20, 10))
-plt.subplot(3, 2, 1)
-plt.plot(cambridge['timestamp'],cambridge['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Cambridge")
-plt.tight_layout()
-
-plt.subplot(3, 2, 2)
-plt.plot(eastbourne['timestamp'],eastbourne['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Eastbourne")
-plt.tight_layout()
-
-plt.subplot(3, 2, 3)
-plt.plot(heathrow['timestamp'],heathrow['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Heathrow")
-plt.tight_layout()
-
-plt.subplot(3, 2, 4)
-plt.plot(lowestoft['timestamp'],lowestoft['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Lowestoft")
-plt.tight_layout()
-
-plt.subplot(3, 2, 5)
-plt.plot(manston['timestamp'],manston['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Manston")
-plt.tight_layout()
-
-plt.subplot(3, 2, 6)
-plt.plot(oxford['timestamp'],oxford['rain_mm'], color='navy')
-plt.xlabel("Time")
-plt.ylabel("Rain (mm)")
-plt.ylim(0,250)
-plt.title("Monthly avg rainfall for Oxford")
-plt.tight_layout()
+def plot_time_series(datasets, output=None):
+    '''Plot the rainfall time series of each location ("datasets" is a dictionary of dfs).
+       If "output" is provided, the figure is saved to that file instead of being left open.
+    '''
+
+    # Imported here so that importing this script doesn't import matplotlib
+    import matplotlib.pyplot as plt
+
+    # Plot
+    ax = plt.figure(figsize=(20, 10))
+
+    for i, (name, data) in enumerate(datasets.items()):
+        plt.subplot(3, 2, i+1)
+        plt.plot(data['timestamp'],data['rain_mm'], color='navy')
+        plt.xlabel("Time")
+        plt.ylabel("Rain (mm)")
+        plt.ylim(0,250)
+        plt.title("Monthly avg rainfall for "+name)
+
+    plt.tight_layout()
+
+    if output is not None:
+        plt.savefig(output)
+        plt.close()
+
+    return ax
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Plot the clean rainfall time series.')
+    parser.add_argument('--output', default=None, help='save the figure to this file (eg, time_series.png)')
+    args = parser.parse_args()
+
+    # Set root dir
+    root = os.path.abspath(os.path.join("__file__", "../.."))
+
+    # Read clean data
+    cutoff = '2000-01-15'
+    locations = ['Cambridge','Eastbourne','Heathrow','Lowestoft','Manston','Oxford']
+    datasets = {location: slice_data(pd.read_csv(root + '/data/clean/'+location.lower()+'.csv', parse_dates=['timestamp'], index_col=0), cutoff=cutoff)
+                for location in locations}
+
+    ax = plot_time_series(datasets, output=args.output)
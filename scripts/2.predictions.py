@@ -1,12 +1,22 @@
 import os
+import sys
+import json
+import argparse
+import time
+import subprocess
+import multiprocessing
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import pickle
+import tensorflow as tf
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_squared_error
-from tensorflow.keras.models import Sequential
+from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.layers import LSTM, Dense, Bidirectional, Dropout
+from tensorflow.keras.callbacks import Callback, EarlyStopping, ReduceLROnPlateau, ModelCheckpoint, CSVLogger
+from stage_cache import StageCache, stage_key, file_hash, save_pickle, load_pickle
+from script_utils import write_atomic
 
 
 def read_data(filepath):
@@ -52,30 +62,48 @@ def scale_data(data):
 
 
 def past_future_windows(scaled_data, n_past, n_future):
-    '''Define two temporal windows: past and future, with different sizes, relative to each month in the time series.'''
+    '''Define two temporal windows: past and future, with different sizes, relative to each month in the time series.
+       Windows are read-only views over the input data (no copies): consecutive windows share memory.
+    '''
 
-    # Empty windows
-    past = [] 
-    future = [] 
+    # Flat, contiguous series. "0" means that the first (and only) column of the numpy array is used
+    series = np.ascontiguousarray(scaled_data[:, 0])
+    stride = series.strides[0]
 
-    # Populate empty windows
     # This creates one window with x values (x/12 years) before a given month
     # and one window with y values (y/12 years) ahead of a given month
-    # "0" means that the first (and only) numerical value in the numpy array is appened to the list
-    for i in range(0, len(scaled_data)-n_past-n_future+1):
-        past.append(scaled_data[i : i + n_past, 0]) 
-        future.append(scaled_data[i + n_past : i + n_past + n_future, 0])
-
-    # Turn lists into numpy arrays
-    past, future = np.array(past), np.array(future)
+    n_windows = max(len(series) - n_past - n_future + 1, 0)
 
-    # Reshape
-    # "1" means that the array will be 2D
-    past = np.reshape(past, (past.shape[0], past.shape[1], 1))
+    # Each row starts one value after the previous one. "1" means that past windows are 2D for each sample
+    past = as_strided(series, shape=(n_windows, n_past, 1), strides=(stride, stride, stride), writeable=False)
+    future = as_strided(series[n_past:], shape=(n_windows, n_future), strides=(stride, stride), writeable=False)
 
     return past, future
 
 
+def past_future_batches(scaled_data, n_past, n_future, batch_size):
+    '''Stream past and future windows in batches of "batch_size" samples.
+       Only one batch is materialised at a time, so very long series or large n_past don't need the whole window matrix in RAM.
+       "scaled_data" can also be a memory-mapped array.
+    '''
+
+    past, future = past_future_windows(scaled_data, n_past, n_future)
+
+    for start in range(0, len(past), batch_size):
+        yield np.array(past[start : start + batch_size]), np.array(future[start : start + batch_size])
+
+
+def past_future_dataset(scaled_data, n_past, n_future, batch_size):
+    '''Wrap "past_future_batches" in a tf.data.Dataset that can be passed to model.fit() directly.'''
+
+    dataset = tf.data.Dataset.from_generator(
+                        lambda: past_future_batches(scaled_data, n_past, n_future, batch_size),
+                        output_types=(tf.float32, tf.float32),
+                        output_shapes=(tf.TensorShape([None, n_past, 1]), tf.TensorShape([None, n_future])))
+
+    return dataset.prefetch(1)
+
+
 def pipeline(filepath, cutoff1, column_index, n_past, n_future):
     '''Apply pipeline to input data. 
        Steps:
@@ -108,29 +136,36 @@ def pipeline(filepath, cutoff1, column_index, n_past, n_future):
     return past, future, validation, sc, result_timestamp, validation_timestamp
 
 
-def fit_lstm(n_past, n_future, past_train, future_train, n_epochs):
-    '''Initialise Keras LSTM model.'''
+def build_lstm(n_past, n_future, past_train, units=None, dropout=0.2):
+    '''Initialise Keras LSTM model.
+       - units: memory units of each LSTM layer (defaults to n_past)
+       - dropout: rate of the dropout layer after each LSTM layer
+    '''
+
+    # Memory units, by default 1 for each month in the n_past window
+    if units is None:
+        units = n_past
 
     # Initialise regressor
     regressor = Sequential()
 
     #==== LAYER 1 (HIDDEN LAYER)
-    # Add bidirectional LSTM with n_past memory units, 1 for each month in the n_past window
-    regressor.add(Bidirectional(LSTM(units=n_past, return_sequences=True, input_shape=(past_train.shape[1],1))))
+    # Add bidirectional LSTM
+    regressor.add(Bidirectional(LSTM(units=units, return_sequences=True, input_shape=(past_train.shape[1],past_train.shape[2]))))
     # Add dropout to prevent overfitting
-    regressor.add(Dropout(rate=0.2))
+    regressor.add(Dropout(rate=dropout))
 
     #==== LAYER 2 (HIDDEN LAYER)
-    regressor.add(LSTM(units=n_past, return_sequences=True))
-    regressor.add(Dropout(rate=0.2))
+    regressor.add(LSTM(units=units, return_sequences=True))
+    regressor.add(Dropout(rate=dropout))
 
     #==== LAYER 3 (HIDDEN LAYER)
-    regressor.add(LSTM(units=n_past, return_sequences=True))
-    regressor.add(Dropout(rate=0.2))
+    regressor.add(LSTM(units=units, return_sequences=True))
+    regressor.add(Dropout(rate=dropout))
 
     #==== LAYER 4 (HIDDEN LAYER)
-    regressor.add(LSTM(units=n_past))
-    regressor.add(Dropout(rate=0.2))
+    regressor.add(LSTM(units=units))
+    regressor.add(Dropout(rate=dropout))
 
     #==== LAYER 5 (OUTPUT LAYER)
     # This layer contains a linear activation function that outputs n_future values
@@ -140,87 +175,199 @@ def fit_lstm(n_past, n_future, past_train, future_train, n_epochs):
     # Compile model
     regressor.compile(optimizer='nadam', loss='mean_squared_error', metrics=['acc'])
 
+    return regressor
+
+
+class EpochTimer(Callback):
+    '''Keras callback adding the wall time of each epoch (in seconds) to the training logs as "epoch_time".'''
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            logs['epoch_time'] = time.time() - self.start
+
+
+def read_training_log(checkpoint):
+    '''Read the per-epoch training log written next to a checkpoint, as a dictionary of lists.'''
+
+    log = pd.read_csv(checkpoint+'.csv')
+
+    return {column: log[column].tolist() for column in log.columns if column != 'epoch'}
+
+
+def fit_lstm(n_past, n_future, past_train, future_train, n_epochs, validation_split=0.0, patience=None, checkpoint=None,
+             units=None, dropout=0.2, batch_size=32):
+    '''Initialise and fit Keras LSTM model.
+       - units, dropout: passed to "build_lstm"
+       - batch_size: number of windows per gradient update
+       - validation_split: fraction of the training windows held out to monitor the loss (0 monitors the training loss)
+       - patience: if provided, stop after "patience" epochs without improvement (restoring the best weights)
+         and halve the learning rate after patience/2 epochs without improvement
+       - checkpoint: if provided, path (without extension) where the model (.h5) and training log (.csv) are saved
+         after each epoch. Training resumes from the last epoch saved, and the checkpoint is deleted once training is finished.
+         The path must be specific to the data and parameters of the model (eg, contain the key of its fit stage)
+       Returns the model and its training history (a dictionary of lists, including epochs run before a resume).
+    '''
+
+    # Resume from last epoch saved, or initialise regressor
+    initial_epoch = 0
+
+    if checkpoint is not None and os.path.exists(checkpoint+'.h5') and os.path.exists(checkpoint+'.csv'):
+        regressor = load_model(checkpoint+'.h5')
+        initial_epoch = len(pd.read_csv(checkpoint+'.csv'))
+        print('Resuming from checkpoint: '+checkpoint+' (epoch '+str(initial_epoch)+')')
+    else:
+        regressor = build_lstm(n_past, n_future, past_train, units=units, dropout=dropout)
+
+    # Training controller
+    monitor = 'val_loss' if validation_split > 0 else 'loss'
+    callbacks = [EpochTimer()]
+
+    if patience is not None:
+        callbacks.append(EarlyStopping(monitor=monitor, patience=patience, restore_best_weights=True))
+        callbacks.append(ReduceLROnPlateau(monitor=monitor, factor=0.5, patience=max(1, patience//2)))
+
+    if checkpoint is not None:
+        os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+        callbacks.append(ModelCheckpoint(checkpoint+'.h5'))
+        callbacks.append(CSVLogger(checkpoint+'.csv', append=initial_epoch > 0))
+
     # Fit model and store loss & accuracy information
-    history = regressor.fit(past_train, future_train, epochs=n_epochs, batch_size=32)
+    history = regressor.fit(past_train, future_train, epochs=n_epochs, batch_size=batch_size, initial_epoch=initial_epoch,
+                            validation_split=validation_split, callbacks=callbacks)
+
+    if checkpoint is None:
+        return regressor, history.history
+
+    # Finished: the checkpoint is only kept to resume an interrupted run
+    training_log = read_training_log(checkpoint)
+    for extension in ['.h5', '.csv']:
+        os.remove(checkpoint+extension)
 
-    return regressor, history
+    return regressor, training_log
 
 
-def model_performance(n_past, n_future, past_train, future_train, n_epochs):
-    '''Fit LSTM models and capture training performance.'''
+def model_performance(n_past, n_future, past_train, future_train, n_epochs, **training_options):
+    '''Fit LSTM models and capture training performance.
+       "training_options" are passed to "fit_lstm" (validation_split, patience, checkpoint, units, dropout, batch_size).
+       Also returns training statistics: epochs run, wall time, and time saved compared to running all n_epochs.
+    '''
 
     # Fit models
-    model, history = fit_lstm(n_past=n_past, n_future=n_future, past_train=past_train, future_train=future_train, n_epochs=n_epochs)
+    model, history = fit_lstm(n_past=n_past, n_future=n_future, past_train=past_train, future_train=future_train, n_epochs=n_epochs,
+                              **training_options)
 
     # Grab accuracy and loss values
-    acc = history.history['acc']
-    loss = history.history['loss']
+    acc = history['acc']
+    loss = history['loss']
+
+    # Training statistics
+    epoch_times = history['epoch_time']
+    stats = {'epochs': len(loss),
+             'max_epochs': n_epochs,
+             'wall_time': float(np.sum(epoch_times)),
+             'time_saved': float((n_epochs - len(loss)) * np.mean(epoch_times)) if len(epoch_times) > 0 else 0.0}
 
-    return model, acc, loss
+    return model, acc, loss, stats
 
 
-def process_bulk_locations(locations, cutoff1, column_index, n_past, n_future, n_epochs):
-    '''For each location, perform the following steps:
-       - 1. Identify filepath
-       - 2. Generate past, future, validation datasets and scaler
-       - 3. Fit model
-       - 4. Store everything in a dictionary
+def location_training_options(training_options, location, key):
+    '''Turn the training options of a bulk run into the "fit_lstm" options of a single location (or of the global model).
+       "key" identifies the data and parameters of the fit (see "stage_key"), so a checkpoint is only resumed by the same fit.
     '''
 
-    # Empty container
-    results = {}
+    training_options = dict(training_options or {})
+    checkpoint_dir = training_options.pop('checkpoint_dir', None)
 
-    for location in locations:
+    if checkpoint_dir is not None:
+        training_options['checkpoint'] = checkpoint_dir+'/'+location+'-'+key[:16]
 
-        print('Location: '+location)
+    return training_options
 
-        # Identify correct filepath
-        filepath = root + '/data/clean/'+str(location)+'.csv'
 
-        # Extract past, future, validation datasets
-        print('Extracting past, future, validation datasets')
-        past, future, validation, sc, result_timestamp, validation_timestamp = pipeline(filepath=filepath, cutoff1=cutoff1,  
-                                            column_index=column_index, n_past=n_past, n_future=n_future)
+def init_training_worker(n_threads):
+    '''Pin the TensorFlow thread pools of a training worker, so that parallel workers don't oversubscribe the CPU.'''
 
-        # Fit model and compute performance
-        print('Fitting model')
-        model, acc, loss = model_performance(n_past=n_past, n_future=n_future, past_train=past, future_train=future, n_epochs=n_epochs)
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
 
-        print('Storing everything in container')
-        results[location] = [model, acc, loss, validation, sc, result_timestamp, validation_timestamp]
+    return
 
-    return results
+
+class StationModel:
+    '''View of a global model (see "process_global_model") for a single station.
+       It adds the station feature to the inputs, so that it can be used like a per-station model (eg, by "evaluate").
+    '''
+
+    def __init__(self, model, station, n_stations, station_feature=True):
+        self.model = model
+        self.station = station
+        self.n_stations = n_stations
+        self.station_feature = station_feature
+
+
+    def predict(self, past, **kwargs):
+        '''Make predictions for this station. Keyword arguments (eg, batch_size) are passed to the Keras model.'''
+
+        if self.station_feature:
+            past = add_station_feature(past, self.station, self.n_stations)
+
+        return self.model.predict(past, **kwargs)
 
 
-def plot_training_performance(container, n_epochs):
-    '''Plot model accuracy and losses during training. 
-       "container" is the output of the "process_bulk_locations" function.
+def add_station_feature(past, station, n_stations):
+    '''Append a one-hot station ID to every time step of the past windows: (N, n_past, 1) -> (N, n_past, 1 + n_stations).'''
+
+    one_hot = np.zeros((past.shape[0], past.shape[1], n_stations), dtype=past.dtype)
+    one_hot[:, :, station] = 1
+
+    return np.concatenate([past, one_hot], axis=2)
+
+
+def process_global_model(locations, cutoff1, column_index, n_past, n_future, n_epochs, station_feature=True, training_options=None):
+    '''Train a single model shared by all locations.
+       Windows of every location (each scaled with its own scaler) are stacked into one dataset, optionally with a
+       one-hot station ID feature, so the cost of compiling and fitting is paid once instead of once per location.
+       The output has the same structure as the results of "process_bulk_locations", with a "StationModel" view in place of each model.
     '''
 
-    # Declare final figure
-    ax = plt.figure(figsize=(20, 10))
+    # Extract past, future, validation datasets for every location
+    datasets = {}
 
-    # Grab x values
-    x = range(0, n_epochs)
+    for station, location in enumerate(locations):
 
-    for i, location in enumerate(container.keys()):
+        print('Location: '+location)
+        filepath = root + '/data/clean/'+str(location)+'.csv'
+        datasets[location] = pipeline(filepath=filepath, cutoff1=cutoff1, column_index=column_index, n_past=n_past, n_future=n_future)
+
+    # Stack windows of all locations
+    if station_feature:
+        past = np.concatenate([add_station_feature(datasets[location][0], station, len(locations))
+                               for station, location in enumerate(locations)], axis=0)
+    else:
+        past = np.concatenate([datasets[location][0] for location in locations], axis=0)
+
+    future = np.concatenate([datasets[location][1] for location in locations], axis=0)
 
-        acc = container[location][1]
-        loss = container[location][2]
+    # Fit a single model and compute performance. The key of the fit covers the data of every location and the parameters
+    fit_key = stage_key('fit', 'global', [file_hash(root + '/data/clean/'+str(location)+'.csv') for location in locations],
+                        cutoff1, column_index, n_past, n_future, n_epochs, station_feature, training_options)
 
-        plt.subplot(3, 2, i+1)
-        plt.plot(x, loss, color='red', label='loss')
-        plt.plot(x, acc, color='navy', label='acc')
+    print('Fitting global model on '+str(len(past))+' windows')
+    model, acc, loss, stats = model_performance(n_past=n_past, n_future=n_future, past_train=past, future_train=future, n_epochs=n_epochs,
+                                                **location_training_options(training_options, 'global', fit_key))
+
+    # Empty container
+    results = {}
 
-        plt.legend()
-        plt.xlabel("Epochs")
-        plt.ylabel("Values")
-        plt.ylim(0,1.0)
-        plt.title("Accuracy vs loss for "+location, fontsize=13)
-        plt.tight_layout()
-        plt.grid("on")
+    for station, location in enumerate(locations):
+        past, future, validation, sc, result_timestamp, validation_timestamp = datasets[location]
+        results[location] = [StationModel(model, station, len(locations), station_feature), acc, loss, validation, sc, result_timestamp, validation_timestamp, stats]
 
-    return ax
+    return results
 
 
 def compute_rmse(predictions, validation):
@@ -238,11 +385,8 @@ def compute_rmse(predictions, validation):
     return rmse
 
 
-def evaluate(container):
-    '''Evaluate on unseen data, compute MRSE, and plot.'''
-
-    # Declare final figure
-    ax = plt.figure(figsize=(20, 10))
+def compute_evaluation(container):
+    '''Evaluate on unseen data and compute RMSE, without plotting.'''
 
     # Empty final container
     evaluation = {}
@@ -281,44 +425,177 @@ def evaluate(container):
         # Add values to evaluation dictionary
         evaluation[location] = [predictions, validation, difference, rmse]
 
-        # Plot
-        x = container[location][6] #Grab validation timestamps
+    return evaluation
+
+
+def backtest(container, cutoff1, column_index, n_past, n_future):
+    '''Rolling-origin evaluation (backtesting) of each model over the whole history since cutoff1.
+       For each location, every origin with n_past months before it and n_future months after it is forecast
+       in a single batched call to model.predict.
+       Returns a tidy df with the following structure (one row per location, origin and horizon):
+
+       location | origin | horizon | in_sample | observed | predicted | error
+
+       "origin" is the first month forecast and "horizon" goes from 1 to n_future. "in_sample" flags forecasts whose
+       months are all part of the training data.
+    '''
+
+    # Empty container
+    tables = []
+
+    for location in container.keys():
+
+        model = container[location][0]
+        sc = container[location][4]
+
+        # Whole history since cutoff1 (training + validation)
+        data = read_data(root + '/data/clean/'+str(location)+'.csv')
+        data = data[data['timestamp'] >= cutoff1].reset_index(drop=True)
+        observed = extract_data(data, column_index=column_index)
+
+        # All rolling origins at once: scaled inputs and observed outputs (in mm)
+        past, _ = past_future_windows(sc.transform(observed), n_past, n_future)
+        _, future = past_future_windows(observed, n_past, n_future)
+
+        # One batched prediction per location, then inverse transformation
+        predictions = model.predict(past, batch_size=256)
+        predictions = predictions * sc.scale_ + sc.mean_
+
+        n_origins = len(past)
+        origins = data['timestamp'].values[n_past : n_past + n_origins]
+
+        tables.append(pd.DataFrame({
+                        'location': location,
+                        'origin': np.repeat(origins, n_future),
+                        'horizon': np.tile(np.arange(1, n_future + 1), n_origins),
+                        'in_sample': np.repeat(np.arange(0, n_origins) + n_past + n_future <= len(data) - n_future, n_future),
+                        'observed': future.flatten(),
+                        'predicted': predictions.flatten()}))
 
-        plt.subplot(3, 2, i+1)
+    table = pd.concat(tables, axis=0, ignore_index=True)
+    table['error'] = table['predicted'] - table['observed']
 
-        plt.plot(x, validation, color='navy', label='validation')
-        plt.plot(x, predictions, color='red', label='predictions')
+    return table
 
-        plt.annotate("RMSE: "+str(rmse), (x[3],202))
 
-        plt.legend()
-        plt.xlabel("Time")
-        plt.ylabel("Rainfall (mm)")
-        plt.ylim(0,250)
-        plt.title("Predictions vs Validation for: "+location, fontsize=13)
-        plt.tight_layout()
-        plt.grid("on")
+def summarise_backtest(table, by):
+    '''Compute RMSE and MAE of a backtest (see "backtest") for each location and origin (by='origin') or horizon (by='horizon').'''
 
+    grouped = table.assign(squared_error=table['error']**2, absolute_error=table['error'].abs()).groupby(['location', by])
 
-    return evaluation, ax
+    summary = pd.DataFrame({'rmse': np.sqrt(grouped['squared_error'].mean()),
+                            'mae': grouped['absolute_error'].mean()}).reset_index()
+
+    return summary
 
 
 def serialise_models(training_performance, root):
-    '''Save Keras model to filepath using HDF5 extension (.h5).'''
+    '''Save Keras model to filepath using HDF5 extension (.h5).
+       Files are replaced atomically (see "write_atomic"), as the dashboard may be reading them.
+    '''
 
     # Access trained models from training_performance dict
     for i, location in enumerate(training_performance.keys()):
         model = training_performance[location][0]
 
+        # A global model is shared by all locations: save it once, with the station index of each location
+        if isinstance(model, StationModel):
+            write_atomic(root+'/models/global_trained_model.h5', model.model.save)
+
+            def write_stations(tmp_filepath):
+                with open(tmp_filepath, 'w') as handle:
+                    json.dump({location: training_performance[location][0].station for location in training_performance.keys()}, handle, indent=2)
+
+            write_atomic(root+'/models/global_stations.json', write_stations)
+
+            return
+
         # Specify filename
         filename = root+'/models/'+location+"_trained_model.h5"
 
         # Save model
-        model.save(filename)
+        write_atomic(filename, model.save)
 
     return
 
 
+def network_arrays(model):
+    '''Extract the layers of a Keras LSTM regressor as a JSON spec and a dictionary of numpy arrays (see inference_class.py).'''
+
+    layers = []
+    arrays = {}
+
+    for layer in model.layers:
+
+        # Dropout is inactive at inference time
+        if isinstance(layer, Dropout):
+            continue
+
+        if isinstance(layer, Bidirectional):
+            config = layer.forward_layer.get_config()
+            spec = {'type': 'bidirectional', 'merge_mode': layer.merge_mode, 'return_sequences': config['return_sequences'],
+                    'activation': config['activation'], 'recurrent_activation': config['recurrent_activation']}
+        elif isinstance(layer, LSTM):
+            config = layer.get_config()
+            spec = {'type': 'lstm', 'return_sequences': config['return_sequences'],
+                    'activation': config['activation'], 'recurrent_activation': config['recurrent_activation']}
+        elif isinstance(layer, Dense):
+            spec = {'type': 'dense', 'activation': layer.get_config()['activation']}
+        else:
+            raise ValueError('Layer not supported by the inference runtime: '+layer.name)
+
+        weights = layer.get_weights()
+        spec['n_weights'] = len(weights)
+
+        for j, weight in enumerate(weights):
+            arrays['w_'+str(len(layers))+'_'+str(j)] = weight.astype(np.float32)
+
+        layers.append(spec)
+
+    return {'layers': layers}, arrays
+
+
+def export_inference_weights(training_performance, root, n_past, n_future):
+    '''Export each trained model to a compact .npz file that inference_class.Inference can run with NumPy only.
+       Files are saved as models/<location>_inference.npz and include the scaler of the location.
+       The weights of a global model are saved once (models/global_inference.npz) and referenced by each location.
+       Files are replaced atomically (see "write_atomic"), as the dashboard may be reading them.
+    '''
+
+    for location in training_performance.keys():
+        model = training_performance[location][0]
+        sc = training_performance[location][4]
+
+        location_spec = {'n_past': n_past, 'n_future': n_future, 'weights': None}
+        arrays = {'mean': sc.mean_.astype(np.float64), 'scale': sc.scale_.astype(np.float64)}
+
+        if isinstance(model, StationModel):
+            network_spec, network_weights = network_arrays(model.model)
+            write_atomic(root+'/models/global_inference.npz',
+                         lambda tmp_filepath: np.savez(tmp_filepath, network_spec=json.dumps(network_spec), **network_weights))
+
+            location_spec['weights'] = 'global_inference.npz'
+            if model.station_feature:
+                location_spec['station'] = model.station
+                location_spec['n_stations'] = model.n_stations
+        else:
+            network_spec, network_weights = network_arrays(model)
+            arrays['network_spec'] = json.dumps(network_spec)
+            arrays.update(network_weights)
+
+        write_atomic(root+'/models/'+location+'_inference.npz',
+                     lambda tmp_filepath: np.savez(tmp_filepath, location_spec=json.dumps(location_spec), **arrays))
+
+    return
+
+
+def save_pickle_file(value, filepath):
+    '''Dump a pickle to filepath.'''
+
+    with open(filepath, 'wb') as handle: # 'wb' stands for: write binary
+        pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
 def serialise_values(dict, root, perf=None, eval=None, cutoff1=None, n_future=None):
     '''Create pickle file from dictionary and save it to filepath.
        Differentiates between training_performance and evaluation dicts.
@@ -335,9 +612,8 @@ def serialise_values(dict, root, perf=None, eval=None, cutoff1=None, n_future=No
         # Define filename
         filename = root + '/results/training_performance/training_perf.pkl'
 
-        # Dump pickle object
-        with open(filename, 'wb') as handle: # 'wb' stands for: write binary
-            pickle.dump(dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        # Dump pickle object (atomically, see "write_atomic")
+        write_atomic(filename, lambda tmp_filepath: save_pickle_file(dict, tmp_filepath))
 
 
     if eval is True:
@@ -358,46 +634,306 @@ def serialise_values(dict, root, perf=None, eval=None, cutoff1=None, n_future=No
         # Define filename
         filename = root + '/results/evaluation/eval.pkl'
 
-        # Dump pickle object
-        with open(filename, 'wb') as handle: # 'wb' stands for: write binary
-            pickle.dump(dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        # Dump pickle object (atomically, see "write_atomic")
+        write_atomic(filename, lambda tmp_filepath: save_pickle_file(dict, tmp_filepath))
 
     return
 
 
-# =========== MAIN ===========
+def serialise_columnar(dict, root):
+    '''Save the series used by the dashboard (predictions, training data and timelines) as columnar .npy files.
+       "dict" is the evaluation dict after it has been serialised by "serialise_values" with eval=True.
+    '''
 
+    # The same module is used by the dashboard's loader, so they can't get out of sync (it only needs NumPy)
+    sys.path.append(root)
+    import columnar
+
+    columnar.write_columnar(dict, root)
+
+    return
+
+
+# =========== CACHED PIPELINE ===========
+
+
+def save_fit(value, folder):
+    '''Writer of the output of the fit stage: Keras model (.h5) and training performance (pickle).'''
+
+    model, acc, loss, stats = value
+    model.save(folder + '/model.h5')
+    save_pickle([acc, loss, stats], folder)
 
-# Set root dir
-root = os.path.abspath(os.path.join("__file__", "../.."))
 
-# Cutoff dates
-cutoff1 = '2000-01-15'
-cutoff2 = '2018-01-15'
+def load_fit(folder):
+    '''Reader of the output of the fit stage.'''
 
-# Parameters
-n_past = 120 #10 years
-n_future = 24 #2 years
-column_index = 4 #"rain_mm" has column_index=4
-n_epochs = 500
+    acc, loss, stats = load_pickle(folder)
 
-# Locations
-locations = ['cambridge','eastbourne','heathrow','lowestoft','manston','oxford']
+    return load_model(folder + '/model.h5'), acc, loss, stats
 
-# Bulk processing
-training_performance = process_bulk_locations(locations, cutoff1, column_index, n_past, n_future, n_epochs)
 
-# Plot training performance
-ax = plot_training_performance(training_performance, n_epochs)
+def prepare_location_cached(location, config):
+    '''Cached data stages of a single location: read -> slice -> scale -> window.
+       The key of each stage is a hash of its parameters and of the keys of the stages before it (the key of "read" is
+       the hash of the clean data), so after a change only the stages downstream of it are computed again.
+       Windows are zero-copy views of the scaled data: they are keyed but never stored.
+       Returns the datasets (same as "pipeline") and the keys of the stages.
+    '''
+
+    cache = StageCache(config['cache_dir'], enabled=config['cache'])
+    filepath = root + '/data/clean/'+str(location)+'.csv'
+    cutoff1, column_index, n_past, n_future = config['cutoff1'], config['column_index'], config['n_past'], config['n_future']
+
+    # Read
+    read_key = stage_key('read', file_hash(filepath))
+    data = cache.run('read', read_key, lambda: read_data(filepath=filepath))
+
+    # Slice
+    slice_key = stage_key('slice', read_key, cutoff1, n_future)
+    train, validation = cache.run('slice', slice_key, lambda: slice_data(data, cutoff1=cutoff1, n_future=n_future))
+
+    # Scale train data only (validation will be scaled by function "evaluate")
+    def scale():
+        scaled, sc = scale_data(extract_data(train, column_index=column_index))
+        return scaled, sc, extract_data(validation, column_index=column_index), train['timestamp'], validation['timestamp']
+
+    scale_key = stage_key('scale', slice_key, column_index)
+    scaled, sc, validation, result_timestamp, validation_timestamp = cache.run('scale', scale_key, scale)
+
+    # Window
+    window_key = stage_key('window', scale_key, n_past, n_future)
+    past, future = past_future_windows(scaled, n_past, n_future)
+
+    return [past, future, validation, sc, result_timestamp, validation_timestamp], [read_key, slice_key, scale_key, window_key]
+
+
+def process_location_cached(location, config, backtesting=True):
+    '''For a single location, process data, fit a model, evaluate and backtest it, with every stage cached:
+       read -> slice -> scale -> window (see "prepare_location_cached") -> fit -> evaluate (and backtest).
+       Returns the results (model, acc, loss, validation, sc, result_timestamp, validation_timestamp, stats), the evaluation,
+       the backtest (None if backtesting is False) and the keys of the stages.
+    '''
+
+    cache = StageCache(config['cache_dir'], enabled=config['cache'])
+    cutoff1, column_index, n_past, n_future = config['cutoff1'], config['column_index'], config['n_past'], config['n_future']
+
+    datasets, data_keys = prepare_location_cached(location, config)
+    past, future, validation, sc, result_timestamp, validation_timestamp = datasets
+    read_key, slice_key, scale_key, window_key = data_keys
+
+    # Fit. Checkpoints are kept with the output of the stage, so they are never reused with different parameters
+    fit_key = stage_key('fit', window_key, config['n_epochs'], config['training_options'])
+    fit_options = dict(config['training_options'])
+    if config['checkpoints']:
+        fit_options['checkpoint'] = cache.path('fit', fit_key) + '/checkpoint'
+
+    print('Location: '+location)
+    model, acc, loss, stats = cache.run('fit', fit_key, save=save_fit, load=load_fit,
+                                        compute=lambda: model_performance(n_past=n_past, n_future=n_future, past_train=past,
+                                                                          future_train=future, n_epochs=config['n_epochs'], **fit_options))
+
+    result = [model, acc, loss, validation, sc, result_timestamp, validation_timestamp, stats]
+
+    # Evaluate
+    evaluate_key = stage_key('evaluate', fit_key, scale_key)
+    evaluation = cache.run('evaluate', evaluate_key, lambda: compute_evaluation({location: result})[location])
+
+    # Backtest
+    backtest_key = stage_key('backtest', fit_key, read_key, cutoff1, column_index, n_past, n_future)
+    backtest_table = None
+    if backtesting:
+        backtest_table = cache.run('backtest', backtest_key, lambda: backtest({location: result}, cutoff1, column_index, n_past, n_future))
+
+    return result, evaluation, backtest_table, [read_key, slice_key, scale_key, window_key, fit_key, evaluate_key, backtest_key]
+
+
+def train_location_worker(location, config):
+    '''Run the cached stages of a single location in a worker process (see "process_location_cached").
+       Keras models can't be sent back to the parent process, so the model is saved to a temporary .h5 file
+       and its filename is returned in place of the model.
+    '''
+
+    result, evaluation, backtest_table, keys = process_location_cached(location, config)
 
-# Evaluation
-evaluation, ax = evaluate(training_performance)
+    filename = root+'/models/'+location+'_'+str(os.getpid())+'.tmp.h5'
+    result[0].save(filename)
+    result[0] = filename
 
-# Save serialised models (.h5)
-serialise_models(training_performance, root)
+    return result, evaluation, backtest_table, keys
 
-# Save serialise training performance values
-serialise_values(dict=training_performance, root=root, perf=True)
 
-# Save serialsied evaluation
-serialise_values(dict=evaluation, root=root, eval=True, cutoff1=cutoff1, n_future=n_future)
\ No newline at end of file
+def process_bulk_locations(locations, config):
+    '''For each location, process data, fit, evaluate and backtest a model (see "process_location_cached") and store everything
+       in dictionaries. With config['n_workers'] > 1, locations are trained in parallel by a pool of processes, with or without
+       the cache. Each worker gets an equal share of the CPUs for its TensorFlow threads and is replaced after each location
+       to release memory.
+       Returns the results and the evaluation of each location, the backtests of all locations and the keys of the stages.
+    '''
+
+    n_workers = config['n_workers']
+
+    if n_workers <= 1:
+        outputs = [process_location_cached(location, config) for location in locations]
+
+    else:
+        # Threads available to each worker
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+        # Spawn fresh interpreters: forking a process that has already initialised TensorFlow is not safe
+        context = multiprocessing.get_context('spawn')
+
+        with context.Pool(processes=n_workers, initializer=init_training_worker, initargs=(n_threads,), maxtasksperchild=1) as pool:
+            outputs = pool.starmap(train_location_worker, [(location, config) for location in locations])
+
+        # Load models saved by the workers
+        for result, _, _, _ in outputs:
+            filename = result[0]
+            result[0] = load_model(filename)
+            os.remove(filename)
+
+    print('Storing everything in container')
+    training_performance, evaluation, tables, keys = {}, {}, [], []
+
+    for location, (result, location_evaluation, location_backtest, location_keys) in zip(locations, outputs):
+        training_performance[location] = result
+        evaluation[location] = location_evaluation
+        tables.append(location_backtest)
+        keys.append(location_keys)
+
+    return training_performance, evaluation, pd.concat(tables, axis=0, ignore_index=True), keys
+
+
+def run(config):
+    '''Run the whole pipeline with the parameters in "config" (see DEFAULT_CONFIG):
+       train, evaluate, backtest and serialise models and results, then render the report if requested.
+       Stages are cached (see "process_location_cached"), except for the global model which is always trained.
+       Locations are trained in parallel with config['n_workers'] > 1 (see "process_bulk_locations").
+       The serialise stage is skipped when its inputs are the same as in the last run.
+    '''
+
+    locations = config['locations']
+    cutoff1, column_index, n_past, n_future, n_epochs = config['cutoff1'], config['column_index'], config['n_past'], config['n_future'], config['n_epochs']
+
+    if config['global_model']:
+        training_options = dict(config['training_options'])
+        if config['checkpoints']:
+            training_options['checkpoint_dir'] = root+'/models/checkpoints'
+
+        training_performance = process_global_model(locations, cutoff1, column_index, n_past, n_future, n_epochs, training_options=training_options)
+        evaluation = compute_evaluation(training_performance)
+        backtest_table = backtest(training_performance, cutoff1, column_index, n_past, n_future)
+        keys = None
+
+    else:
+        training_performance, evaluation, backtest_table, keys = process_bulk_locations(locations, config)
+
+    # Serialise (skipped if the results on disk were produced from the same stages, and are still there)
+    # The key covers the config, so a run of the other mode (global or per-location model) never matches it
+    serialise_key = stage_key('serialise', keys, config) if keys is not None else None
+    marker = root + '/results/.stage_key'
+
+    previous_key = None
+    if os.path.exists(marker):
+        with open(marker, 'r') as handle:
+            previous_key = handle.read()
+
+    outputs = [root + '/results/columnar/manifest.json'] + [root+'/models/'+location+'_inference.npz' for location in locations]
+
+    if config['cache'] and serialise_key is not None and previous_key == serialise_key and all(os.path.exists(output) for output in outputs):
+        print('Cached: serialise ('+serialise_key[:12]+')')
+    else:
+        # Removed first: results serialised without a key (global model) or interrupted don't match any later run
+        if os.path.exists(marker):
+            os.remove(marker)
+
+        # Backtesting over all rolling origins (metrics only, no plotting)
+        backtest_table.to_csv(root + '/results/evaluation/backtest.csv', index=False)
+        summarise_backtest(backtest_table, by='horizon').to_csv(root + '/results/evaluation/backtest_by_horizon.csv', index=False)
+
+        # Save serialised models (.h5)
+        serialise_models(training_performance, root)
+
+        # Export models for the NumPy inference runtime (inference_class.py)
+        export_inference_weights(training_performance, root, n_past, n_future)
+
+        # Save serialise training performance values
+        serialise_values(dict=training_performance, root=root, perf=True)
+
+        # Save serialsied evaluation
+        serialise_values(dict=evaluation, root=root, eval=True, cutoff1=cutoff1, n_future=n_future)
+
+        # Save columnar evaluation (memory-mappable, read by the dashboard one location at a time)
+        serialise_columnar(dict=evaluation, root=root)
+
+        if serialise_key is not None:
+            with open(marker, 'w') as handle:
+                handle.write(serialise_key)
+
+    # Reporting stage: render figures from the serialised results in a separate, TensorFlow-free process
+    if len(config['report_formats']) > 0:
+        subprocess.run([sys.executable, '3.reporting.py', '--formats'] + config['report_formats'], cwd=root + '/scripts', check=True)
+
+    return training_performance, evaluation
+
+
+def parse_config(argv):
+    '''Build the configuration of a run: DEFAULT_CONFIG, updated with a JSON config file (--config) and then with the command line.'''
+
+    parser = argparse.ArgumentParser(description='Train, evaluate and serialise the LSTM rainfall models.')
+    parser.add_argument('--config', default=None, help='JSON file with any of the keys of DEFAULT_CONFIG')
+    parser.add_argument('--cutoff1', default=None, help='first month used, eg 2000-01-15')
+    parser.add_argument('--n-past', type=int, default=None, help='months used as input')
+    parser.add_argument('--n-future', type=int, default=None, help='months predicted')
+    parser.add_argument('--n-epochs', type=int, default=None, help='maximum number of epochs')
+    parser.add_argument('--locations', nargs='+', default=None, help='locations (clean csv names)')
+    parser.add_argument('--workers', type=int, default=None, help='number of locations trained in parallel')
+    parser.add_argument('--global-model', action='store_true', default=None, help='train a single model shared by all locations')
+    parser.add_argument('--report', nargs='+', default=None, help='render figures after the run, in these formats (eg, png svg)')
+    parser.add_argument('--no-cache', action='store_true', help='compute every stage, without reading or writing the cache')
+    args = parser.parse_args(argv)
+
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+
+    if args.config is not None:
+        with open(args.config, 'r') as handle:
+            config.update(json.load(handle))
+
+    overrides = {'cutoff1': args.cutoff1, 'n_past': args.n_past, 'n_future': args.n_future, 'n_epochs': args.n_epochs,
+                 'locations': args.locations, 'n_workers': args.workers, 'global_model': args.global_model, 'report_formats': args.report}
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    if args.no_cache:
+        config['cache'] = False
+
+    config['cache_dir'] = root + '/cache'
+
+    return config
+
+
+# =========== MAIN ===========
+
+
+# Set root dir
+root = os.path.abspath(os.path.join("__file__", "../.."))
+
+# Default parameters of a run (see "parse_config")
+DEFAULT_CONFIG = {
+    'cutoff1': '2000-01-15',
+    'n_past': 120, #10 years
+    'n_future': 24, #2 years
+    'column_index': 4, #"rain_mm" has column_index=4
+    'n_epochs': 500,
+    'locations': ['cambridge','eastbourne','heathrow','lowestoft','manston','oxford'],
+    'n_workers': 1, #Number of locations trained in parallel
+    'global_model': False, #Train a single model shared by all locations instead of one model per location
+    # Training controller: early stopping on a validation split and learning rate reduced on plateau
+    'training_options': {'validation_split': 0.1, 'patience': 50},
+    'checkpoints': True, #Per-epoch checkpoints to resume an interrupted run
+    'report_formats': [], #Figures rendered by 3.reporting.py after the run, eg ['png', 'svg'] (none by default)
+    'cache': True #Cache the output of each stage in cache/
+}
+
+if __name__ == '__main__':
+
+    run(parse_config(sys.argv[1:]))
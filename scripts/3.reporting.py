@@ -0,0 +1,95 @@
+import os
+import argparse
+import multiprocessing
+from script_utils import read_pickle
+
+
+def render_location(location, acc, loss, timestamps, validation, predictions, rmse, folder, formats):
+    '''Render the figures of a single location and save them to file, one per format:
+       - <location>_training: accuracy vs loss during training
+       - <location>_evaluation: predictions vs validation
+    '''
+
+    # Figures are created without pyplot (no GUI backend): they are only written to file
+    from matplotlib.figure import Figure
+
+    filenames = []
+
+    # Training performance
+    figure = Figure(figsize=(10, 5))
+    ax = figure.add_subplot(1, 1, 1)
+
+    x = range(0, len(loss))
+    ax.plot(x, loss, color='red', label='loss')
+    ax.plot(x, acc, color='navy', label='acc')
+
+    ax.legend()
+    ax.set_xlabel("Epochs")
+    ax.set_ylabel("Values")
+    ax.set_ylim(0,1.0)
+    ax.set_title("Accuracy vs loss for "+location, fontsize=13)
+    ax.grid(True)
+    figure.tight_layout()
+
+    for format in formats:
+        filenames.append(folder+'/'+location+'_training.'+format)
+        figure.savefig(filenames[-1])
+
+    # Evaluation
+    figure = Figure(figsize=(10, 5))
+    ax = figure.add_subplot(1, 1, 1)
+
+    ax.plot(timestamps, validation, color='navy', label='validation')
+    ax.plot(timestamps, predictions, color='red', label='predictions')
+    ax.annotate("RMSE: "+str(rmse), (timestamps[3],202))
+
+    ax.legend()
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Rainfall (mm)")
+    ax.set_ylim(0,250)
+    ax.set_title("Predictions vs Validation for: "+location, fontsize=13)
+    ax.grid(True)
+    figure.tight_layout()
+
+    for format in formats:
+        filenames.append(folder+'/'+location+'_evaluation.'+format)
+        figure.savefig(filenames[-1])
+
+    return filenames
+
+
+def report(root, formats=('png',), n_workers=None):
+    '''Render the figures of every location from the serialised results (training_perf.pkl and eval.pkl).
+       Locations are rendered in parallel by a pool of processes and saved to results/figures/.
+       This stage doesn't need TensorFlow, and matplotlib is only imported by the workers.
+    '''
+
+    training_performance = read_pickle(root + '/results/training_performance/training_perf.pkl')
+    evaluation = read_pickle(root + '/results/evaluation/eval.pkl')
+
+    folder = root + '/results/figures'
+    os.makedirs(folder, exist_ok=True)
+
+    # Arguments of each location (training_perf.pkl: acc, loss, ...; eval.pkl: predictions, validation, difference, rmse, train, validation df)
+    args = [(location, training_performance[location][0], training_performance[location][1],
+             evaluation[location][5]['timestamp'].values, evaluation[location][1], evaluation[location][0],
+             evaluation[location][3], folder, list(formats)) for location in evaluation.keys()]
+
+    with multiprocessing.get_context('spawn').Pool(processes=n_workers) as pool:
+        outputs = pool.starmap(render_location, args)
+
+    return [filename for filenames in outputs for filename in filenames]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render training and evaluation figures from the serialised results.')
+    parser.add_argument('--formats', nargs='+', default=['png'], help='file formats, eg png svg')
+    parser.add_argument('--workers', type=int, default=None, help='number of parallel processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    # Set root dir
+    root = os.path.abspath(os.path.join("__file__", "../.."))
+
+    for filename in report(root, formats=args.formats, n_workers=args.workers):
+        print('Written: '+filename)
@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import pandas as pd
+import numpy as np
+from script_utils import load_script
+
+
+# Training pipeline and stage cache of 2.predictions.py (the main section only runs when it is called as a script)
+predictions = load_script('2.predictions.py', 'predictions')
+
+# Hyperparameters explored by a sweep
+PARAMETERS = ['n_past', 'n_future', 'units', 'dropout', 'batch_size']
+
+
+def grid_trials(space):
+    '''Return every combination of the values in "space" (a dictionary of lists keyed by hyperparameter).'''
+
+    return [dict(zip(PARAMETERS, values)) for values in itertools.product(*[space[parameter] for parameter in PARAMETERS])]
+
+
+def random_trials(space, n_trials, seed=0):
+    '''Return "n_trials" combinations drawn at random (without repetitions) from the grid of "space".'''
+
+    trials = grid_trials(space)
+    rng = np.random.RandomState(seed)
+    chosen = rng.choice(len(trials), size=min(n_trials, len(trials)), replace=False)
+
+    return [trials[i] for i in sorted(chosen)]
+
+
+def trial_config(sweep, trial):
+    '''Turn a trial into the configuration of a pipeline run (see DEFAULT_CONFIG in 2.predictions.py).
+       Units, dropout and batch size are training options, so they are part of the key of the fit stage.
+    '''
+
+    config = json.loads(json.dumps(predictions.DEFAULT_CONFIG))
+    config.update({'cutoff1': sweep['cutoff1'], 'n_epochs': sweep['n_epochs'], 'cache': True,
+                   'cache_dir': predictions.root + '/cache', 'n_past': trial['n_past'], 'n_future': trial['n_future']})
+    config['training_options'].update({'units': trial['units'], 'dropout': trial['dropout'], 'batch_size': trial['batch_size']})
+
+    return config
+
+
+def inference_latency(model, sc, n_past, n_future, n_repeats=20):
+    '''Median latency (in ms) of a single forecast with the NumPy inference runtime, which serves the dashboard.'''
+
+    sys.path.append(predictions.root)
+    from inference_class import Inference
+
+    # Same arrays as the exported .npz file, kept in memory
+    network_spec, arrays = predictions.network_arrays(model)
+    weights = [[arrays['w_'+str(i)+'_'+str(j)] for j in range(0, layer['n_weights'])] for i, layer in enumerate(network_spec['layers'])]
+    runtime = Inference((None, network_spec['layers'], weights), sc.mean_, sc.scale_, n_past, n_future)
+
+    # The latency doesn't depend on the values
+    series = np.full(n_past, sc.mean_[0])
+    runtime.forecast(series)
+
+    timings = []
+    for i in range(0, n_repeats):
+        start = time.perf_counter()
+        runtime.forecast(series)
+        timings.append(time.perf_counter() - start)
+
+    return float(np.median(timings)) * 1000
+
+
+def run_trial(trial_id, location, trial, sweep):
+    '''Train (or load from the cache) and evaluate the model of one location for one trial.
+       Returns a row of the results table.
+    '''
+
+    config = trial_config(sweep, trial)
+    result, evaluation, _, keys = predictions.process_location_cached(location, config, backtesting=False)
+
+    model, sc, stats = result[0], result[4], result[7]
+
+    row = {'trial': trial_id, 'location': location}
+    row.update(trial)
+    row.update({'rmse': evaluation[3],
+                'epochs': stats['epochs'],
+                'train_wall_time': stats['wall_time'],
+                'inference_ms': inference_latency(model, sc, trial['n_past'], trial['n_future'], sweep['n_repeats']),
+                'n_weights': int(model.count_params()),
+                'fit_key': keys[4]})
+
+    return row
+
+
+def cache_trial_worker(location, trial, sweep):
+    '''Train the model of one location for one trial in a worker process (outputs are only kept in the cache).'''
+
+    predictions.process_location_cached(location, trial_config(sweep, trial), backtesting=False)
+
+    return location
+
+
+def init_sweep_worker(n_threads):
+    '''Pin the TensorFlow thread pools of a sweep worker (see "init_training_worker" in 2.predictions.py).'''
+
+    predictions.init_training_worker(n_threads)
+
+    return
+
+
+def summarise_sweep(table, target_rmse=None):
+    '''Average the trials of each combination over the locations, flag those meeting the accuracy target
+       (mean RMSE <= target_rmse) and sort them from the fastest to the slowest at inference, then at training.
+    '''
+
+    summary = table.groupby(PARAMETERS).agg(rmse=('rmse', 'mean'),
+                                            train_wall_time=('train_wall_time', 'mean'),
+                                            inference_ms=('inference_ms', 'mean'),
+                                            n_weights=('n_weights', 'first')).reset_index()
+
+    summary['meets_target'] = True if target_rmse is None else summary['rmse'] <= target_rmse
+
+    return summary.sort_values(by=['meets_target', 'inference_ms', 'train_wall_time'], ascending=[False, True, True]).reset_index(drop=True)
+
+
+def sweep(config):
+    '''Run a hyperparameter sweep with the parameters in "config" (see DEFAULT_SWEEP):
+       every trial trains one model per location, in parallel over a pool of processes.
+       Trials reuse the stage cache of 2.predictions.py: the data stages are shared by all trials with the same
+       n_past and n_future, and trials already run are loaded instead of trained again.
+       Workers only fill the cache: models are then loaded one at a time, so that latencies are timed on an idle CPU.
+       Results are saved to results/sweep/sweep.csv (one row per trial and location) and sweep_summary.csv.
+    '''
+
+    if config['search'] == 'random':
+        trials = random_trials(config['space'], config['n_trials'], config['seed'])
+    else:
+        trials = grid_trials(config['space'])
+
+    print('Trials: '+str(len(trials))+' x '+str(len(config['locations']))+' locations')
+
+    # Fill the data stages once, so that workers only read them
+    for trial in trials:
+        for location in config['locations']:
+            predictions.prepare_location_cached(location, trial_config(config, trial))
+
+    if config['n_workers'] > 1:
+        n_threads = max(1, (os.cpu_count() or 1) // config['n_workers'])
+        context = multiprocessing.get_context('spawn')
+
+        with context.Pool(processes=config['n_workers'], initializer=init_sweep_worker, initargs=(n_threads,), maxtasksperchild=1) as pool:
+            pool.starmap(cache_trial_worker, [(location, trial, config) for trial in trials for location in config['locations']])
+
+    rows = [run_trial(trial_id, location, trial, config) for trial_id, trial in enumerate(trials) for location in config['locations']]
+    table = pd.DataFrame(rows)
+    summary = summarise_sweep(table, config['target_rmse'])
+
+    folder = predictions.root + '/results/sweep'
+    os.makedirs(folder, exist_ok=True)
+    table.to_csv(folder + '/sweep.csv', index=False)
+    summary.to_csv(folder + '/sweep_summary.csv', index=False)
+
+    return table, summary
+
+
+def parse_sweep_config(argv):
+    '''Build the configuration of a sweep: DEFAULT_SWEEP, updated with a JSON config file (--config) and then with the command line.'''
+
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the LSTM rainfall models.')
+    parser.add_argument('--config', default=None, help='JSON file with any of the keys of DEFAULT_SWEEP')
+    parser.add_argument('--search', choices=['grid', 'random'], default=None, help='try every combination, or a random sample of them')
+    parser.add_argument('--trials', type=int, default=None, help='number of combinations tried by a random search')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random search')
+    parser.add_argument('--n-past', type=int, nargs='+', default=None, help='values of n_past')
+    parser.add_argument('--n-future', type=int, nargs='+', default=None, help='values of n_future')
+    parser.add_argument('--units', type=int, nargs='+', default=None, help='values of the units of each LSTM layer')
+    parser.add_argument('--dropout', type=float, nargs='+', default=None, help='values of the dropout rate')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=None, help='values of the batch size')
+    parser.add_argument('--n-epochs', type=int, default=None, help='maximum number of epochs of each trial')
+    parser.add_argument('--locations', nargs='+', default=None, help='locations (clean csv names)')
+    parser.add_argument('--workers', type=int, default=None, help='number of models trained in parallel')
+    parser.add_argument('--target-rmse', type=float, default=None, help='accuracy target: maximum mean RMSE (in mm) over the locations')
+    args = parser.parse_args(argv)
+
+    config = json.loads(json.dumps(DEFAULT_SWEEP))
+
+    if args.config is not None:
+        with open(args.config, 'r') as handle:
+            config.update(json.load(handle))
+
+    overrides = {'search': args.search, 'n_trials': args.trials, 'seed': args.seed, 'n_epochs': args.n_epochs,
+                 'locations': args.locations, 'n_workers': args.workers, 'target_rmse': args.target_rmse}
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    space = {'n_past': args.n_past, 'n_future': args.n_future, 'units': args.units, 'dropout': args.dropout, 'batch_size': args.batch_size}
+    config['space'].update({key: value for key, value in space.items() if value is not None})
+
+    return config
+
+
+# =========== MAIN ===========
+
+
+# Default parameters of a sweep (see "parse_sweep_config")
+DEFAULT_SWEEP = {
+    'search': 'grid', #'grid' or 'random'
+    'n_trials': 10, #Combinations tried by a random search
+    'seed': 0,
+    'space': {'n_past': [24, 60, 120],
+              'n_future': [24],
+              'units': [16, 32, 64],
+              'dropout': [0.2],
+              'batch_size': [32, 64]},
+    'cutoff1': '2000-01-15',
+    'n_epochs': 100,
+    'locations': ['cambridge','eastbourne','heathrow','lowestoft','manston','oxford'],
+    'n_workers': 2, #Number of models trained in parallel
+    'n_repeats': 20, #Forecasts timed to measure the inference latency
+    'target_rmse': None #Accuracy target used to pick the fastest model, in mm
+}
+
+if __name__ == '__main__':
+
+    table, summary = sweep(parse_sweep_config(sys.argv[1:]))
+
+    print(summary.to_string(index=False))
+
+    candidates = summary[summary['meets_target']]
+    if len(candidates) > 0:
+        print('Fastest model meeting the target: ' + str(candidates.iloc[0][PARAMETERS].to_dict()))
+    else:
+        print('No model meets the target')
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from script_utils import load_script, read_pickle
+
+
+# Cleansing and training pipelines (the main sections only run when they are called as scripts)
+cleansing = load_script('0.data_cleansing.py', 'data_cleansing')
+predictions = load_script('2.predictions.py', 'predictions')
+
+
+def ingest_new_months(root, locations):
+    '''Append the new months of the raw file of each location to its clean csv (see "append_new_months" in 0.data_cleansing.py).
+       Raw files that did not change since the last ingestion are skipped, and the ingestion state is updated,
+       so that a later bulk ingestion doesn't parse them again.
+       Returns the number of months appended to each location.
+    '''
+
+    raw_folder = root + '/data/raw'
+    output_folder = root + '/data/clean'
+    state_filepath = output_folder + '/.ingestion_state.json'
+
+    state = {}
+    if os.path.exists(state_filepath):
+        with open(state_filepath, 'r') as f:
+            state = json.load(f)
+
+    # Raw files are capitalised (eg, Oxford.txt), clean csvs are not
+    raw_files = {filename.split('.')[0].lower(): filename for filename in os.listdir(raw_folder) if filename.endswith('.txt')}
+    appended = {}
+
+    for location in locations:
+        filename = raw_files[location]
+        previous = state.get(filename)
+        signature = cleansing.file_signature(raw_folder + '/' + filename, previous)
+
+        if previous is not None and previous['sha256'] == signature['sha256']:
+            appended[location] = 0
+            continue
+
+        output, new_rows = cleansing.append_new_months(raw_folder + '/' + filename, output_folder)
+        appended[location] = len(new_rows)
+        state[filename] = signature
+
+        print('Appended '+str(len(new_rows))+' months to '+output)
+
+    def write_state(tmp_filepath):
+        with open(tmp_filepath, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+
+    cleansing.write_atomic(state_filepath, write_state)
+
+    return appended
+
+
+def stale_locations(performance, locations):
+    '''Locations whose clean data end after the last month their model was evaluated on (validation_timestamp in training_perf.pkl).
+       As this only depends on the results, an update interrupted after the ingestion is completed by the next one.
+    '''
+
+    stale = []
+
+    for location in locations:
+        clean = pd.read_csv(root + '/data/clean/'+location+'.csv', usecols=['timestamp'], parse_dates=['timestamp'])
+
+        if location in performance and clean['timestamp'].max() > performance[location][5].max():
+            stale.append(location)
+
+    return stale
+
+
+def served_by_global_model(location):
+    '''Whether the published model of a location is the global model, ie its exported model (models/<location>_inference.npz)
+       references the shared weights (see "export_inference_weights" in 2.predictions.py).
+       Per-location models (.h5) of an earlier run may still be on disk: they are not the ones published.
+    '''
+
+    filepath = root+'/models/'+location+'_inference.npz'
+
+    if not os.path.exists(filepath):
+        return False
+
+    with np.load(filepath, allow_pickle=False) as data:
+        return json.loads(str(data['location_spec'])).get('weights') is not None
+
+
+def fine_tune_location(location, performance, config):
+    '''Update the model of a single location with the months appended to its clean csv:
+       - 1. Slice the clean data as a full run would (the last n_future months are held out for validation)
+       - 2. Update the scaler with the months that entered the training data since the model was trained (partial_fit)
+       - 3. Fine-tune the saved model (.h5) for a few epochs on the windows of the updated training data
+       "performance" is the entry of the location in training_perf.pkl.
+       Returns the results with the structure of "process_location_cached".
+    '''
+
+    cutoff1, column_index, n_past, n_future = config['cutoff1'], config['column_index'], config['n_past'], config['n_future']
+
+    data = predictions.read_data(root + '/data/clean/'+location+'.csv')
+    train, validation = predictions.slice_data(data, cutoff1=cutoff1, n_future=n_future)
+
+    # Incremental statistics: the scaler already holds the mean and variance of the months it was fit on
+    acc, loss, sc, result_timestamp = performance[0], performance[1], performance[3], performance[4]
+    new_months = train[train['timestamp'] > result_timestamp.max()]
+    if len(new_months) > 0:
+        sc.partial_fit(predictions.extract_data(new_months, column_index=column_index))
+
+    scaled = sc.transform(predictions.extract_data(train, column_index=column_index))
+    past, future = predictions.past_future_windows(scaled, n_past, n_future)
+
+    # Optimizer state (eg, a learning rate reduced on plateau) is restored with the model, unless a learning rate is given
+    model = predictions.load_model(root+'/models/'+location+'_trained_model.h5')
+    if config['learning_rate'] is not None:
+        model.compile(optimizer=predictions.tf.keras.optimizers.Nadam(learning_rate=config['learning_rate']),
+                      loss='mean_squared_error', metrics=['acc'])
+    history = model.fit(past, future, epochs=config['n_epochs'], batch_size=config['batch_size'],
+                        callbacks=[predictions.EpochTimer()], verbose=0)
+
+    # Previous statistics are missing from results serialised before they were recorded
+    stats = dict(performance[6]) if len(performance) > 6 else {'epochs': len(loss), 'max_epochs': None, 'wall_time': None, 'time_saved': None}
+    stats.update({'fine_tune_epochs': stats.get('fine_tune_epochs', 0) + len(history.history['loss']),
+                  'fine_tune_wall_time': stats.get('fine_tune_wall_time', 0.0) + float(sum(history.history['epoch_time']))})
+
+    return [model, list(acc) + history.history['acc'], list(loss) + history.history['loss'],
+            predictions.extract_data(validation, column_index=column_index), sc, train['timestamp'], validation['timestamp'], stats]
+
+
+def write_pickle_atomic(value, filepath):
+    '''Dump a pickle through a temporary file (see "write_atomic" in script_utils.py).'''
+
+    def write(tmp_filepath):
+        with open(tmp_filepath, 'wb') as handle:
+            pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    cleansing.write_atomic(filepath, write)
+
+    return
+
+
+def update_results(training_performance, evaluation, config):
+    '''Rewrite the results of the locations in "training_performance" only: models (.h5 and .npz), their entries
+       in training_perf.pkl and eval.pkl, and their columnar files (the other locations of the manifest are kept).
+       Pickles and the manifest are replaced atomically, so the dashboard picks up the new version on its next rerun.
+       Backtests are not updated: the stage marker is removed, so that the next full run serialises everything again.
+    '''
+
+    locations = list(training_performance.keys())
+
+    predictions.serialise_models(training_performance, root)
+    predictions.export_inference_weights(training_performance, root, config['n_past'], config['n_future'])
+
+    # Same entries as "serialise_values", for the updated locations only
+    performance_filepath = root + '/results/training_performance/training_perf.pkl'
+    all_performance = read_pickle(performance_filepath) if os.path.exists(performance_filepath) else {}
+    all_performance.update({location: training_performance[location][1:] for location in locations})
+    write_pickle_atomic(all_performance, performance_filepath)
+
+    evaluation_filepath = root + '/results/evaluation/eval.pkl'
+    all_evaluation = read_pickle(evaluation_filepath) if os.path.exists(evaluation_filepath) else {}
+
+    for location in locations:
+        data = predictions.read_data(root + '/data/clean/'+location+'.csv')
+        train, validation = predictions.slice_data(data, cutoff1=config['cutoff1'], n_future=config['n_future'])
+        all_evaluation[location] = list(evaluation[location]) + [train, validation]
+
+    write_pickle_atomic(all_evaluation, evaluation_filepath)
+
+    sys.path.append(root)
+    import columnar
+
+    columnar.write_columnar({location: all_evaluation[location] for location in locations}, root, update=True)
+
+    marker = root + '/results/.stage_key'
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    return
+
+
+def incremental_update(config):
+    '''Refresh the results with the new months of the raw files, without a full reprocessing:
+       only the new months are appended to the clean data, and only the locations with months their model has not seen are
+       fine-tuned, evaluated and rewritten (see "stale_locations", "fine_tune_location" and "update_results").
+       Locations trained by a global model are not supported: they need a full run of 2.predictions.py.
+       Returns the results and evaluation of the updated locations.
+    '''
+
+    ingest_new_months(root, config['locations'])
+
+    performance = read_pickle(root + '/results/training_performance/training_perf.pkl')
+    locations = stale_locations(performance, config['locations'])
+
+    print('Locations with new months: '+str(locations))
+
+    if len(locations) == 0:
+        return {}, {}
+
+    training_performance = {}
+
+    for location in locations:
+        if served_by_global_model(location):
+            print('Skipped (trained by the global model, run 2.predictions.py): '+location)
+            continue
+
+        if not os.path.exists(root+'/models/'+location+'_trained_model.h5'):
+            print('Skipped (no trained model of this location, run 2.predictions.py): '+location)
+            continue
+
+        start = time.time()
+        training_performance[location] = fine_tune_location(location, performance[location], config)
+        print('Fine-tuned: '+location+' ('+str(round(time.time() - start, 1))+' s)')
+
+    if len(training_performance) == 0:
+        return {}, {}
+
+    evaluation = predictions.compute_evaluation(training_performance)
+
+    update_results(training_performance, evaluation, config)
+
+    return training_performance, evaluation
+
+
+def parse_update_config(argv):
+    '''Build the configuration of an update: DEFAULT_UPDATE, updated with a JSON config file (--config) and then with the command line.
+       The window sizes and cutoff must be the ones the models were trained with.
+    '''
+
+    parser = argparse.ArgumentParser(description='Append new months and fine-tune the models of the locations that received them.')
+    parser.add_argument('--config', default=None, help='JSON file with any of the keys of DEFAULT_UPDATE')
+    parser.add_argument('--locations', nargs='+', default=None, help='locations (clean csv names)')
+    parser.add_argument('--n-epochs', type=int, default=None, help='epochs of fine-tuning')
+    parser.add_argument('--learning-rate', type=float, default=None, help='learning rate of fine-tuning (default: the one saved with each model)')
+    args = parser.parse_args(argv)
+
+    config = json.loads(json.dumps(DEFAULT_UPDATE))
+
+    if args.config is not None:
+        with open(args.config, 'r') as handle:
+            config.update(json.load(handle))
+
+    overrides = {'locations': args.locations, 'n_epochs': args.n_epochs, 'learning_rate': args.learning_rate}
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    return config
+
+
+# =========== MAIN ===========
+
+
+# Set root dir (same as 2.predictions.py)
+root = predictions.root
+
+# Default parameters of an update (see "parse_update_config"): windows and cutoff of the models trained by 2.predictions.py
+DEFAULT_UPDATE = {
+    'cutoff1': predictions.DEFAULT_CONFIG['cutoff1'],
+    'n_past': predictions.DEFAULT_CONFIG['n_past'],
+    'n_future': predictions.DEFAULT_CONFIG['n_future'],
+    'column_index': predictions.DEFAULT_CONFIG['column_index'],
+    'locations': predictions.DEFAULT_CONFIG['locations'],
+    'n_epochs': 5, #Epochs of fine-tuning (a full run trains up to 500)
+    'batch_size': 32,
+    'learning_rate': None #Learning rate of fine-tuning (None keeps the optimizer saved with each model)
+}
+
+if __name__ == '__main__':
+
+    start = time.time()
+    training_performance, evaluation = incremental_update(parse_update_config(sys.argv[1:]))
+
+    for location in evaluation.keys():
+        print(location+': RMSE '+str(evaluation[location][3]))
+    print('Updated '+str(len(evaluation))+' locations in '+str(round(time.time() - start, 1))+' s')
@@ -0,0 +1,276 @@
+import os
+import sys
+import glob
+import shutil
+import asyncio
+import hashlib
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from script_utils import load_script
+
+
+# Cleansing code (the main section only runs when it is called as a script). TensorFlow is never imported by the watcher
+cleansing = load_script('0.data_cleansing.py', 'data_cleansing')
+
+
+def ingest_drop(root, filepaths, drop_folder):
+    '''Append the new months of station files dropped in "drop_folder" to data/clean/ (see "append_new_months" in
+       0.data_cleansing.py), then move them to data/raw/. Files are parsed where they were dropped, so a raw file is only
+       replaced once its new version has been appended. Files that can't be parsed (or have no months) are moved to
+       <drop_folder>/failed/.
+       Returns the locations that received new months.
+    '''
+
+    locations = []
+
+    for filepath in filepaths:
+        raw_filepath = root + '/data/raw/' + os.path.basename(filepath)
+
+        try:
+            if len(cleansing.file_to_df(filepath)) == 0:
+                raise ValueError('no months found')
+
+            output, new_rows = cleansing.append_new_months(filepath, root + '/data/clean')
+
+            # Copied then renamed, as the drop folder may be on another file system
+            cleansing.write_atomic(raw_filepath, lambda tmp_filepath: shutil.copyfile(filepath, tmp_filepath))
+            os.remove(filepath)
+        except Exception as e:
+            print('Failed: ' + filepath + ' (' + str(e) + ')')
+            os.makedirs(drop_folder + '/failed', exist_ok=True)
+            if os.path.exists(filepath):
+                os.replace(filepath, drop_folder + '/failed/' + os.path.basename(filepath))
+            continue
+
+        print('Appended ' + str(len(new_rows)) + ' months to ' + output)
+
+        if len(new_rows) > 0:
+            locations.append(os.path.basename(output).split('.')[0])
+
+    return locations
+
+
+def publish(root, locations):
+    '''Forecast the n_future months after the last month of each location with the NumPy inference runtime, and publish
+       the clean data and the forecasts as a new version of the columnar results read by the dashboard.
+       The other locations are kept as they are, and the version is published by replacing the manifest (see "write_columnar"
+       in columnar.py): the dashboard picks it up on its next rerun, without a restart.
+       Locations without an exported model (models/<location>_inference.npz) or not in the results yet are skipped.
+       Only columnar.py and inference_class.py are imported from the app (NumPy only, no Streamlit).
+       Returns the locations published.
+    '''
+
+    sys.path.append(root)
+    import columnar
+    from inference_class import Inference
+
+    folder = root + '/results/columnar'
+    manifest = columnar.read_manifest(folder + '/manifest.json')
+    locations = [location for location in locations
+                 if location in manifest['locations'] and os.path.exists(root + '/models/' + location + '_inference.npz')]
+
+    if len(locations) == 0:
+        return locations
+
+    # Same forecasts as "Utils.forecast" of the dashboard: locations sharing a global model are batched together
+    data = {location: pd.read_csv(root + '/data/clean/' + location + '.csv', parse_dates=['timestamp'], index_col=0) for location in locations}
+    models = {location: Inference.load(root + '/models/' + location + '_inference.npz') for location in locations}
+    forecasts = Inference.forecast_many(models, {location: data[location]['rain_mm'].values for location in locations})
+
+    evaluation = {}
+
+    for location in locations:
+        # Historic values start from the same month as in the published results
+        first_month = columnar.load_arrays(manifest, folder, location)['training_timeline'][0]
+        historic = data[location][data[location]['timestamp'] >= first_month][['timestamp', 'rain_mm']].reset_index(drop=True)
+
+        last_month = data[location]['timestamp'].values[-1].astype('datetime64[M]')
+        timeline = (last_month + np.arange(1, models[location].n_future + 1)).astype('datetime64[D]') + np.timedelta64(14, 'D')
+        predicted = pd.DataFrame({'timestamp': timeline.astype('datetime64[ns]')})
+
+        # Same structure as eval.pkl, for the entries read by "write_columnar" (validation and difference are unknown)
+        evaluation[location] = [forecasts[location][0], None, None, manifest['locations'][location]['rmse'], historic, predicted]
+
+    columnar.write_columnar(evaluation, root, update=True)
+
+    return locations
+
+
+def process_drop(root, filepaths, drop_folder):
+    '''Ingest dropped files, then forecast and publish the locations that received new months, as a single version.'''
+
+    locations = ingest_drop(root, filepaths, drop_folder)
+    published = publish(root, locations)
+
+    if len(published) > 0:
+        print('Published: ' + ', '.join(published))
+
+    return published
+
+
+def stable_files(folder, signatures):
+    '''Station files (*.txt) of "folder" whose size and mtime didn't change since the previous poll, ie completely written.
+       "signatures" holds the signatures seen at the previous poll and is updated in place.
+    '''
+
+    stable = []
+    current = {}
+
+    for filepath in sorted(glob.glob(folder + '/*.txt')):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+
+        current[filepath] = (stat.st_size, stat.st_mtime_ns)
+
+        if signatures.get(filepath) == current[filepath]:
+            stable.append(filepath)
+
+    signatures.clear()
+    signatures.update(current)
+
+    return stable
+
+
+async def watch_folder(folder, queue, interval):
+    '''Poll the drop folder every "interval" seconds and queue the files completely written.
+       Files stay in the folder until they are ingested, so each file is only queued once.
+    '''
+
+    signatures = {}
+    queued = set()
+
+    while True:
+        stable = stable_files(folder, signatures)
+
+        # Files ingested since the last poll can be queued again if they are dropped again
+        queued &= set(signatures.keys())
+
+        for filepath in stable:
+            if filepath not in queued:
+                queued.add(filepath)
+                await queue.put(filepath)
+
+        await asyncio.sleep(interval)
+
+
+def fetch(url, timeout=30):
+    '''Download a file.'''
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+async def watch_feed(url, stations, folder, interval, executor):
+    '''Poll an HTTP feed serving one file per station (<url>/<Station>.txt) every "interval" seconds.
+       Files whose content changed since the last poll are written to the drop folder (atomically), where "watch_folder" picks them up.
+       Downloads run in "executor", so they don't block the event loop.
+    '''
+
+    loop = asyncio.get_event_loop()
+    hashes = {}
+    unavailable = set()
+
+    while True:
+        for station in stations:
+            try:
+                content = await loop.run_in_executor(executor, fetch, url.rstrip('/') + '/' + station + '.txt')
+            except Exception as e:
+                # Logged once, until the station is available again
+                if station not in unavailable:
+                    print('Feed unavailable for ' + station + ' (' + str(e) + ')')
+                    unavailable.add(station)
+                continue
+
+            unavailable.discard(station)
+
+            sha256 = hashlib.sha256(content).hexdigest()
+
+            if hashes.get(station) != sha256:
+                hashes[station] = sha256
+
+                def write(tmp_filepath):
+                    with open(tmp_filepath, 'wb') as handle:
+                        handle.write(content)
+
+                cleansing.write_atomic(folder + '/' + station + '.txt', write)
+
+        await asyncio.sleep(interval)
+
+
+async def publish_loop(root, queue, drop_folder, executor):
+    '''Process the queued files: files queued together (eg, a monthly drop of every station) are published as a single version.
+       Ingestion, inference and publication run in "executor" (one at a time), so the watchers keep polling meanwhile.
+    '''
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        filepaths = [await queue.get()]
+        while not queue.empty():
+            filepaths.append(queue.get_nowait())
+
+        try:
+            await loop.run_in_executor(executor, process_drop, root, filepaths, drop_folder)
+        except Exception as e:
+            print('Publication failed (' + str(e) + ')')
+
+
+def watch(root, drop_folder, interval=5.0, feed=None, feed_interval=3600.0):
+    '''Watch the drop folder (and the HTTP feed, if any) until interrupted.'''
+
+    os.makedirs(drop_folder, exist_ok=True)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    queue = asyncio.Queue()
+    publisher = ThreadPoolExecutor(max_workers=1)
+    downloader = ThreadPoolExecutor(max_workers=1)
+
+    tasks = [watch_folder(drop_folder, queue, interval), publish_loop(root, queue, drop_folder, publisher)]
+
+    if feed is not None:
+        stations = pd.read_csv(root + '/data/LOCATIONS.csv')['Station'].tolist()
+        tasks.append(watch_feed(feed, stations, drop_folder, feed_interval, downloader))
+
+    print('Watching ' + drop_folder + (' and ' + feed if feed is not None else ''))
+
+    try:
+        loop.run_until_complete(asyncio.gather(*tasks))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.shutdown()
+        downloader.shutdown()
+        loop.close()
+
+    return
+
+
+# =========== MAIN ===========
+
+
+# Set root dir
+root = os.path.abspath(os.path.join("__file__", "../.."))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Watch for new station files, forecast and publish them to the dashboard.')
+    parser.add_argument('--drop', default=root + '/data/incoming', help='folder where new raw station files (MetOffice format) are dropped')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between two polls of the drop folder')
+    parser.add_argument('--feed', default=None, help='URL of an HTTP feed serving <Station>.txt files (eg, python -m http.server)')
+    parser.add_argument('--feed-interval', type=float, default=3600.0, help='seconds between two polls of the feed')
+    parser.add_argument('--once', action='store_true', help='process the files in the drop folder and exit')
+    args = parser.parse_args()
+
+    args.drop = os.path.abspath(args.drop)
+
+    if args.once:
+        process_drop(root, sorted(glob.glob(args.drop + '/*.txt')), args.drop)
+    else:
+        watch(root, args.drop, args.interval, args.feed, args.feed_interval)
@@ -0,0 +1,49 @@
+import os
+import pickle
+import importlib.util
+
+
+# Helpers shared by the pipeline scripts of this folder
+
+
+def load_script(filename, name):
+    '''Import a script of this folder as a module (script names start with a digit, so they can't be imported directly).'''
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(os.path.abspath(__file__)), filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def read_pickle(filepath):
+    '''Read pickle file.'''
+
+    with open(filepath, 'rb') as handle:
+        value = pickle.load(handle)
+
+    return value
+
+
+def write_atomic(filepath, write):
+    '''Write a file through a temporary file in the same folder, then rename it.
+       Readers either see the previous file or the complete new one, never a partial file.
+       "write" is called with the path of the temporary file: a hidden file with the same extension
+       (some writers, eg Keras or np.savez, pick the format from it), so folder scans (eg, *.txt) skip it.
+    '''
+
+    folder, filename = os.path.split(filepath)
+    tmp_filepath = os.path.join(folder, '.' + str(os.getpid()) + '.tmp.' + filename)
+
+    try:
+        write(tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        # "write" may have failed before creating the temporary file: the original error is raised either way
+        try:
+            os.remove(tmp_filepath)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return
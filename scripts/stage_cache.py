@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import tempfile
+
+
+def file_hash(filepath):
+    '''Return the sha256 hash of the content of a file.'''
+
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def stage_key(stage, *inputs):
+    '''Return the key of a pipeline stage: a hash of the stage name and of its inputs.
+       Inputs are parameters and the keys of upstream stages, so a change anywhere upstream changes the key.
+    '''
+
+    return hashlib.sha256(json.dumps([stage] + list(inputs), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_pickle(value, folder):
+    '''Default writer of stage outputs.'''
+
+    with open(folder + '/value.pkl', 'wb') as handle:
+        pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_pickle(folder):
+    '''Default reader of stage outputs.'''
+
+    with open(folder + '/value.pkl', 'rb') as handle:
+        return pickle.load(handle)
+
+
+class StageCache:
+    '''Content-addressed cache of the outputs of pipeline stages.
+       Each output is stored in <folder>/<stage>/<key>/ and is only reused if it was completely written.
+       Stages whose outputs can't be pickled (eg, Keras models) provide their own "save" and "load" functions.
+       When disabled, stages are computed in a temporary folder and the cache folder is never read or written.
+    '''
+
+    def __init__(self, folder, enabled=True):
+        self.folder = folder
+        self.enabled = enabled
+        self.scratch = None
+
+
+    def path(self, stage, key):
+        '''Folder of the output of a stage (a temporary folder outside the cache when disabled).'''
+
+        if not self.enabled:
+            if self.scratch is None:
+                self.scratch = tempfile.mkdtemp(prefix='stage_cache_')
+            return self.scratch + '/' + stage + '/' + key
+
+        return self.folder + '/' + stage + '/' + key
+
+
+    def run(self, stage, key, compute, save=save_pickle, load=load_pickle):
+        '''Return the cached output of a stage, or compute it and cache it.
+           The folder of the stage exists while "compute" runs, so it can be used for intermediate files (eg, checkpoints).
+        '''
+
+        path = self.path(stage, key)
+
+        if self.enabled and os.path.exists(path + '/.done'):
+            print('Cached: ' + stage + ' (' + key[:12] + ')')
+            return load(path)
+
+        os.makedirs(path, exist_ok=True)
+        value = compute()
+
+        if self.enabled:
+            save(value, path)
+            open(path + '/.done', 'w').close()
+        else:
+            # Remove the temporary folder (and its parents, once no other stage uses them)
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(path))
+                os.rmdir(self.scratch)
+                self.scratch = None
+            except OSError:
+                pass
+
+        return value
@@ -0,0 +1,76 @@
+import os
+import sys
+import importlib.util
+import numpy as np
+import pytest
+
+
+# Folders of the app and of the pipeline scripts
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SCRIPTS = ROOT + '/scripts'
+
+N_PAST = 12
+N_FUTURE = 3
+
+
+@pytest.fixture(scope='module')
+def predictions():
+    '''2.predictions.py as a module, reading the clean data of the repository.'''
+
+    if SCRIPTS not in sys.path:
+        sys.path.append(SCRIPTS)
+
+    spec = importlib.util.spec_from_file_location('predictions', SCRIPTS + '/2.predictions.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # The root is set relative to the working directory (scripts/) when run as a script
+    module.root = ROOT
+
+    return module
+
+
+class GlobalModel:
+    '''Stand-in for the Keras model of a global model: predicts zeros (ie, the mean of each scaler) and records its calls.'''
+
+    def __init__(self, n_stations):
+        self.n_stations = n_stations
+        self.calls = []
+
+
+    def predict(self, past, batch_size=None):
+        self.calls.append({'shape': past.shape, 'stations': past[0, 0, 1:].copy(), 'batch_size': batch_size})
+
+        return np.zeros((past.shape[0], N_FUTURE))
+
+
+def test_backtest_global_model(predictions):
+    locations = ['oxford', 'heathrow']
+    cutoff1 = predictions.DEFAULT_CONFIG['cutoff1']
+    column_index = predictions.DEFAULT_CONFIG['column_index']
+
+    model = GlobalModel(len(locations))
+    container = {}
+
+    for station, location in enumerate(locations):
+        data = predictions.read_data(ROOT + '/data/clean/' + location + '.csv')
+        _, sc = predictions.scale_data(predictions.extract_data(data[data['timestamp'] >= cutoff1], column_index=column_index))
+
+        # Same structure as the results of "process_global_model"
+        container[location] = [predictions.StationModel(model, station, len(locations)), None, None, None, sc]
+
+    table = predictions.backtest(container, cutoff1, column_index, N_PAST, N_FUTURE)
+
+    # One batched call per location, with the station feature of the location
+    assert [call['batch_size'] for call in model.calls] == [256, 256]
+    assert [call['shape'][2] for call in model.calls] == [1 + len(locations)] * 2
+    assert [list(call['stations']) for call in model.calls] == [[1, 0], [0, 1]]
+
+    for location in locations:
+        rows = table[table['location'] == location]
+        sc = container[location][4]
+
+        assert len(rows) == model.calls[locations.index(location)]['shape'][0] * N_FUTURE
+        assert list(rows['horizon'].iloc[:N_FUTURE]) == list(range(1, N_FUTURE + 1))
+        np.testing.assert_allclose(rows['predicted'], sc.mean_[0])
+        np.testing.assert_allclose(rows['error'], rows['predicted'] - rows['observed'])
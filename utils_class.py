@@ -1,8 +1,32 @@
+import os
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
 import pickle
 import streamlit as st
 import datetime as dt
+from instrumentation import timed, REGISTRY
+import columnar
+
+
+# Process-wide caches shared by all Streamlit sessions
+# Artifacts are keyed on their filepath and versioned with the hash of their content
+_versions = {}
+_artifacts = {}
+_derived = {}
+
+# "_lock" only guards the dictionaries. Loads and builds hold the lock of their key (see "_key_lock"),
+# so a slow load only blocks the sessions waiting for the same object
+_lock = threading.RLock()
+_key_locks = {}
+
+
+def _key_lock(key):
+    '''Return the lock of a cache key (created on first use).'''
+
+    with _lock:
+        return _key_locks.setdefault(key, threading.RLock())
 
 
 class Utils:
@@ -16,14 +40,147 @@ class Utils:
         self.selected_date = self.add_time_slider(format, start_date_str, end_date_str)
 
 
-    #@st.cache  #Decorator caching data for faster runtimes
-    def read_data_from_pickles(locations):
-        '''Read rainfall data and predictions from pickle file.'''
+    def artifact_version(filepath):
+        '''Return the version (content hash) of the artifact currently on disk.
+           The hash is only recomputed when the file's mtime or size change.
+        '''
+
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        with _key_lock(('version', filepath)):
+            with _lock:
+                entry = _versions.get(filepath)
+
+            if entry is None or entry[0] != signature:
+                with open(filepath, 'rb') as f:
+                    entry = (signature, hashlib.sha256(f.read()).hexdigest())
+
+                with _lock:
+                    _versions[filepath] = entry
+
+            return entry[1]
+
+
+    def load_artifact(filepath, loader):
+        '''Load an artifact from disk once per version and share it across sessions.
+           "loader" turns the filepath into a Python object (eg, Utils.read_pickle); use one loader per file.
+           The file is only re-loaded when its content hash changes (see "artifact_version").
+           Returns the version and the loaded object, which is shared: its arrays are read-only (see "freeze").
+        '''
+
+        filepath = os.path.abspath(filepath)
+
+        with _key_lock(('artifact', filepath)):
+            version = Utils.artifact_version(filepath)
+
+            with _lock:
+                entry = _artifacts.get(filepath)
+
+            hit = entry is not None and entry[0] == version
+            REGISTRY.cache('artifact:' + os.path.basename(filepath), hit)
+
+            if not hit:
+                entry = (version, Utils.freeze(loader(filepath)))
+
+                with _lock:
+                    _artifacts[filepath] = entry
+
+            return entry
 
-        with open('./results/evaluation/eval.pkl', 'rb') as f:
+
+    def freeze(value):
+        '''Make the numpy arrays of an object shared across sessions read-only, so that no session can modify it in place:
+           writes raise "ValueError: assignment destination is read-only" (copy the object first, eg df.copy(), to modify it).
+           Goes through dicts, lists, tuples, dfs and series (including their index) and the attributes of other objects.
+           Returns the object itself.
+        '''
+
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+        elif isinstance(value, (pd.DataFrame, pd.Series)):
+            # Blocks hold the values of the columns. Extension arrays (eg, datetimes) wrap a numpy array
+            for block in value._mgr.blocks:
+                array = block.values
+                array = getattr(array, '_ndarray', getattr(array, '_data', array))
+                if isinstance(array, np.ndarray):
+                    array.flags.writeable = False
+
+            Utils.freeze(np.asarray(value.index))
+
+        elif isinstance(value, dict):
+            for item in value.values():
+                Utils.freeze(item)
+
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                Utils.freeze(item)
+
+        elif hasattr(value, '__dict__') and not callable(value):
+            Utils.freeze(vars(value))
+
+        return value
+
+
+    def clear_caches():
+        '''Drop every artifact and derived object shared across sessions, so that the next reads load from disk (eg, to time cold loads).'''
+
+        with _lock:
+            _versions.clear()
+            _artifacts.clear()
+            _derived.clear()
+
+        return
+
+
+    def read_pickle(filepath):
+        '''Read pickle file.'''
+
+        with open(filepath, 'rb') as f:
             data = pickle.load(f)
 
-        # Extract data for all locations
+        return data
+
+
+    def derive(name, version, args, build):
+        '''Build an object derived from a versioned artifact once and share it across sessions.
+           Objects derived from older versions of the same artifact are dropped. Shared objects are read-only (see "freeze").
+        '''
+
+        key = (name, args)
+
+        with _key_lock(('derive', key)):
+            with _lock:
+                entry = _derived.get(key)
+
+            hit = entry is not None and entry[0] == version
+            REGISTRY.cache('derive:' + name, hit)
+
+            if not hit:
+                entry = (version, Utils.freeze(build()))
+
+                with _lock:
+                    _derived[key] = entry
+
+            return entry[1]
+
+
+    @timed('read_data_from_pickles')
+    def read_data_from_pickles(locations):
+        '''Read rainfall data and predictions from pickle file.
+           The pickle is loaded once per version and the dataframes are shared by all sessions (read-only, see "freeze").
+        '''
+
+        version, data = Utils.load_artifact('./results/evaluation/eval.pkl', Utils.read_pickle)
+
+        return Utils.derive('values', version, tuple(locations), lambda: Utils.extract_values(data, locations))
+
+
+    def extract_values(data, locations):
+        '''Extract historic and predicted values for all locations from the evaluation dictionary.'''
+
         values = {}
 
         for location in locations:
@@ -32,35 +189,226 @@ class Utils:
             training_timeline = data[location][4]['timestamp'].values
             prediction_timeline = data[location][5]['timestamp'].values
 
-            # Combine timelines
-            timeline = np.concatenate([training_timeline, prediction_timeline])
+            values[location] = Utils.combine_values(predictions, training_data, training_timeline, prediction_timeline)
+
+        return values
+
+
+    def combine_values(predictions, training_data, training_timeline, prediction_timeline):
+        '''Combine historic and predicted values of a single location into a df with the following structure:
+
+           date | rain (mm) | type
+        '''
+
+        # Aggregate past data
+        past = pd.DataFrame(index=range(0, len(training_timeline)))
+        past['date'] = training_timeline
+        past['rain (mm)'] = training_data
+        past['type'] = 'historic'
+
+        # Aggregate future data
+        future = pd.DataFrame(index=range(0, len(prediction_timeline)))
+        future['date'] = prediction_timeline
+        future['rain (mm)'] = np.ravel(predictions)
+        future['type'] = 'predicted'
+
+        to_plot = pd.concat([past,future], axis=0)
+
+        return to_plot
+
+
+    def downsample(to_plot, bucket_size):
+        '''Decimate the historic values of a single location (same structure as "combine_values") by keeping
+           the minimum and the maximum of every "bucket_size" consecutive months, in chronological order,
+           so that peaks are still shown at any resolution. Predicted values are always kept.
+        '''
+
+        historic = to_plot[to_plot['type'] == 'historic']
+
+        if bucket_size <= 1 or len(historic) <= 2:
+            return to_plot
+
+        # One row per bucket (the last one padded). Missing values are never picked over a value of the same bucket
+        rain = historic['rain (mm)'].values.astype(np.float64)
+        n_buckets = -(-len(rain) // bucket_size)
+
+        padded = np.full(n_buckets * bucket_size, np.nan)
+        padded[:len(rain)] = rain
+        padded = padded.reshape(n_buckets, bucket_size)
+
+        start = np.arange(0, n_buckets) * bucket_size
+        minima = start + np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+        maxima = start + np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+
+        keep = np.unique(np.concatenate([minima, maxima]))
+        keep = keep[keep < len(rain)]
+
+        return pd.concat([historic.iloc[keep], to_plot[to_plot['type'] != 'historic']], axis=0)
+
+
+    def lod_levels(to_plot, bucket_sizes=(1, 3, 6, 12)):
+        '''Precompute the series of a single location at several levels of detail (see "downsample"),
+           from every month (1) to the minimum and maximum of each year (12).
+           Returns a dictionary of dfs keyed by bucket size.
+        '''
+
+        return {bucket_size: Utils.downsample(to_plot, bucket_size) for bucket_size in bucket_sizes}
 
-            # Aggregate past data
-            past = pd.DataFrame(index=range(0, len(training_timeline)))
-            past['date'] = training_timeline
-            past['rain (mm)'] = training_data
-            past['type'] = 'historic'
 
-            # Aggregate future data
-            future = pd.DataFrame(index=range(0, len(prediction_timeline)))
-            future['date'] = prediction_timeline
-            future['rain (mm)'] = predictions
-            future['type'] = 'predicted'
+    def select_lod(levels, max_points):
+        '''Return the most detailed level with at most "max_points" rows (or the least detailed level).'''
+
+        bucket_sizes = sorted(levels.keys())
+
+        for bucket_size in bucket_sizes:
+            if len(levels[bucket_size]) <= max_points:
+                return levels[bucket_size]
+
+        return levels[bucket_sizes[-1]]
+
+
+    def read_columnar_arrays(location, manifest_path='./results/columnar/manifest.json'):
+        '''Memory-map the arrays of a single location from the columnar results (see columnar.py).
+           Only the files of the location requested are opened.
+        '''
+
+        version, manifest = Utils.load_artifact(manifest_path, columnar.read_manifest)
+
+        return columnar.load_arrays(manifest, os.path.dirname(os.path.abspath(manifest_path)), location)
+
+
+    @timed('read_data_from_columnar')
+    def read_data_from_columnar(locations, manifest_path='./results/columnar/manifest.json'):
+        '''Read rainfall data and predictions for the locations requested from the columnar results.
+           The dataframes are built once per manifest version and shared by all sessions (read-only, see "freeze").
+        '''
 
-            to_plot = pd.concat([past,future], axis=0)
+        version, _ = Utils.load_artifact(manifest_path, columnar.read_manifest)
 
-            values[location] = to_plot
+        def build():
+            values = {}
+
+            for location in locations:
+                arrays = Utils.read_columnar_arrays(location, manifest_path)
+                values[location] = Utils.combine_values(arrays['predictions'], arrays['training_data'],
+                                                        arrays['training_timeline'], arrays['prediction_timeline'])
+
+            return values
+
+        return Utils.derive('columnar_values', version, tuple(locations), build)
+
+
+    @timed('read_values')
+    def read_values(locations):
+        '''Read rainfall data and predictions, preferring the columnar results over the pickle file when available.'''
+
+        if os.path.exists('./results/columnar/manifest.json'):
+            return Utils.read_data_from_columnar(locations)
+
+        return Utils.read_data_from_pickles(locations)
+
+
+    def read_series_arrays(location):
+        '''Return the arrays of a single location (predictions, training_data, training_timeline, prediction_timeline),
+           from the columnar results when available, otherwise from the pickle file.
+        '''
+
+        if os.path.exists('./results/columnar/manifest.json'):
+            return Utils.read_columnar_arrays(location)
+
+        version, data = Utils.load_artifact('./results/evaluation/eval.pkl', Utils.read_pickle)
+
+        return {'predictions': np.ravel(data[location][0]),
+                'training_data': data[location][4]['rain_mm'].values,
+                'training_timeline': data[location][4]['timestamp'].values,
+                'prediction_timeline': data[location][5]['timestamp'].values}
+
+
+    @timed('read_store')
+    def read_store(locations):
+        '''Read rainfall data and predictions of all locations into a compact station x month store (see "RainfallStore").
+           The store is built once per version of the data of the locations and of the coordinates, and shared by all sessions.
+        '''
+
+        version = tuple(Utils.values_version(location) for location in locations) + (Utils.artifact_version('./data/LOCATIONS.csv'),)
+
+        def build():
+            series = {location: Utils.read_series_arrays(location) for location in locations}
+            return RainfallStore.from_series(series, Utils.read_coordinates(), version)
+
+        return Utils.derive('store', version, tuple(locations), build)
+
+
+    def values_version(location):
+        '''Return the version of the data of a single location read by "read_values".
+           With columnar results, this is a hash of the arrays of the location, so it only changes when they change;
+           otherwise it is the version of the pickle file.
+        '''
+
+        if os.path.exists('./results/columnar/manifest.json'):
+            version, manifest = Utils.load_artifact('./results/columnar/manifest.json', columnar.read_manifest)
+            arrays = manifest['locations'][location]['arrays']
+
+            return hashlib.sha256(''.join(arrays[name]['sha256'] for name in sorted(arrays.keys())).encode()).hexdigest()
+
+        return Utils.artifact_version('./results/evaluation/eval.pkl')
+
+
+    def read_clean_data(location):
+        '''Read the clean data of a location (see scripts/0.data_cleansing.py), once per file version.'''
+
+        version, data = Utils.load_artifact('./data/clean/'+location+'.csv', lambda filepath: pd.read_csv(filepath, parse_dates=['timestamp'], index_col=0))
+
+        return data
+
+
+    def read_inference_models(locations):
+        '''Load the models exported for the NumPy inference runtime (models/<location>_inference.npz), once per file version.'''
+
+        from inference_class import Inference
+
+        return {location: Utils.load_artifact('./models/'+location+'_inference.npz', Inference.load)[1] for location in locations}
+
+
+    def forecast(locations):
+        '''Forecast the n_future months after the last month in the clean data of each location, on demand.
+           Uses the NumPy inference runtime (no TensorFlow); locations sharing a global model are batched together.
+           Returns a dictionary of dfs with the same structure as the predicted part of "read_data_from_pickles".
+        '''
+
+        from inference_class import Inference
+
+        models = Utils.read_inference_models(locations)
+        series = {location: Utils.read_clean_data(location)['rain_mm'].values for location in locations}
+
+        forecasts = Inference.forecast_many(models, series)
+
+        values = {}
+
+        for location in locations:
+            last_month = Utils.read_clean_data(location)['timestamp'].values[-1].astype('datetime64[M]')
+            timeline = (last_month + np.arange(1, models[location].n_future + 1)).astype('datetime64[D]') + np.timedelta64(14, 'D')
+
+            values[location] = pd.DataFrame({'date': timeline.astype('datetime64[ns]'),
+                                             'rain (mm)': forecasts[location][0],
+                                             'type': 'predicted'})
 
         return values
 
 
-    #@st.cache
     def read_coordinates():
-        '''Read coordinates from file.'''
+        '''Read coordinates from file.
+           The file is parsed once per version and the dictionary is shared by all sessions.
+        '''
+
+        version, base_file = Utils.load_artifact('./data/LOCATIONS.csv', pd.read_csv)
 
-        base_file = pd.read_csv('./data/LOCATIONS.csv')
+        return Utils.derive('coordinates', version, (), lambda: Utils.extract_coordinates(base_file))
+
+
+    def extract_coordinates(base_file):
+        '''Extract coordinates for all locations from the locations df.'''
 
-        # Extract data for all locations
         coordinates = {}
 
         for index, row in base_file.iterrows():
@@ -96,4 +444,124 @@ class Utils:
         value=dt.date(2000,1,15), 
         format=format)
 
-        return selected_date
\ No newline at end of file
+        return selected_date
+
+
+
+class RainfallStore:
+    '''Compact station x month store of historic and predicted rainfall, read by every visualization of the dashboard:
+       - stations: df with one row per station (location | lat | lon), in the order of the rows of the matrices
+       - months: month axis (datetime64[M]) shared by all stations
+       - rain: float32 matrix (stations x months) of monthly rainfall in mm, NaN where a station has no value
+       - predicted: boolean matrix (stations x months), True where the value is predicted
+       - version: version of the data it was built from (see "Utils.read_store")
+       Monthly values are dated on the 15th of their month, as in the clean data.
+    '''
+
+    def __init__(self, stations, months, rain, predicted, version=None):
+        self.stations = stations
+        self.months = months
+        self.rain = rain
+        self.predicted = predicted
+        self.version = version
+
+
+    def from_series(series, coordinates, version=None):
+        '''Build the store from the arrays of each location (see "Utils.read_series_arrays") and the coordinates.'''
+
+        locations = list(series.keys())
+        stations = pd.DataFrame({'location': locations,
+                                 'lat': [coordinates[location][0] for location in locations],
+                                 'lon': [coordinates[location][1] for location in locations]})
+
+        # Month of every historic and predicted value
+        timelines = {location: (np.asarray(arrays['training_timeline']).astype('datetime64[M]'),
+                                np.asarray(arrays['prediction_timeline']).astype('datetime64[M]'))
+                     for location, arrays in series.items()}
+
+        first = min(min(historic.min(), future.min()) for historic, future in timelines.values())
+        last = max(max(historic.max(), future.max()) for historic, future in timelines.values())
+        months = np.arange(first, last + 1)
+
+        rain = np.full((len(locations), len(months)), np.nan, dtype=np.float32)
+        predicted = np.zeros((len(locations), len(months)), dtype=bool)
+
+        for row, location in enumerate(locations):
+            historic, future = timelines[location]
+            rain[row, (historic - first).astype(int)] = series[location]['training_data']
+            rain[row, (future - first).astype(int)] = np.ravel(series[location]['predictions'])
+            predicted[row, (future - first).astype(int)] = True
+
+        return RainfallStore(stations, months, rain, predicted, version)
+
+
+    def dates(self, columns=slice(None)):
+        '''Dates (15th of the month) of the months selected, as datetime64[ns].'''
+
+        return (self.months[columns].astype('datetime64[D]') + np.timedelta64(14, 'D')).astype('datetime64[ns]')
+
+
+    def values(self, rows, columns):
+        '''Monthly values as float64, rounded to 0.01 mm (the matrix is float32).'''
+
+        return np.round(self.rain[rows, columns].astype(np.float64), 2)
+
+
+    def month_index(self, date):
+        '''Column of the month of "date", or None if it is outside of the month axis.'''
+
+        column = int((np.datetime64(date, 'M') - self.months[0]).astype(int))
+
+        if column < 0 or column >= len(self.months):
+            return None
+
+        return column
+
+
+    def series(self, location):
+        '''Values of a single location, with the structure of "Utils.combine_values":
+
+           date | rain (mm) | type
+        '''
+
+        row = int(np.flatnonzero(self.stations['location'].values == location)[0])
+        columns = np.flatnonzero(~np.isnan(self.rain[row]))
+
+        return pd.DataFrame({'date': self.dates(columns),
+                             'rain (mm)': self.values(row, columns),
+                             'type': np.where(self.predicted[row, columns], 'predicted', 'historic')})
+
+
+    @timed('at_month')
+    def at_month(self, date):
+        '''Values of all stations at the month of "date" (stations without a value are left out), with the structure:
+
+           location | lat | lon | rain | type
+        '''
+
+        column = self.month_index(date)
+
+        if column is None:
+            return pd.DataFrame(columns=['location','lat','lon','rain','type'])
+
+        rows = np.flatnonzero(~np.isnan(self.rain[:, column]))
+        selected = self.stations.iloc[rows].reset_index(drop=True)
+
+        return selected.assign(rain=self.values(rows, column),
+                               type=np.where(self.predicted[rows, column], 'predicted', 'historic'))
+
+
+    def monthly(self):
+        '''All values in long format, station by station, with the structure:
+
+           date | location | lat | lon | rain | type
+        '''
+
+        rows, columns = np.nonzero(~np.isnan(self.rain))
+
+        return pd.DataFrame({'date': self.dates(columns),
+                             'location': self.stations['location'].values[rows],
+                             'lat': self.stations['lat'].values[rows],
+                             'lon': self.stations['lon'].values[rows],
+                             'rain': self.values(rows, columns),
+                             'type': np.where(self.predicted[rows, columns], 'predicted', 'historic')})